@@ -1,9 +1,9 @@
 import array
 import pydicom
-from pydicom.sequence import Sequence
 from pydicom import Dataset , DataElement 
 from pydicom.dataset import FileMetaDataset
 from pydicom.uid import UID
+from pydicom.tag import Tag
 import json
 import logging
 import importlib  
@@ -14,27 +14,138 @@ import sys
 import time
 import os
 import gzip
+import copy
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 logging.basicConfig( level="INFO" )
 
+# VRs of public tags by key as looked up in the pydicom dictionary, None for keys not in the dictionary
+dictionaryVRs = {}
+
+
+def decodeFrame(frameBlob):
+    # Module level, so that it can run in a worker process
+    start_time = time.time()
+    b = io.BytesIO(frameBlob)
+    d = decode(b)
+    end_time = time.time()
+    return d, (end_time - start_time)*1000
+
+
 class MedicalImaging: 
-    def __init__(self):
-        session = boto3.Session()
-        self.client = boto3.client('medical-imaging')
+    def __init__(self, client=None, maxFramesInFlight=8, decodeWorkers=0, metadataCacheSize=32, metadataCacheDir=None, metadataCacheMaxBytes=1024**3, versionCacheSeconds=300, decodePool=None):
+        # client can be any object with the boto3 medical-imaging client methods, e.g. a local stub for testing.
+        # maxFramesInFlight is the number of concurrent frame requests, decodeWorkers the number of decoding
+        # processes (0 to decode in the fetching threads, None for one per CPU). The decoding processes are started
+        # on first use and run until close() is called, so they are off by default. Alternatively, an existing
+        # executor can be passed as decodePool, which is then used instead and not shut down by close().
+        # Decompressed image set metadata is cached in memory for the last metadataCacheSize image set versions and,
+        # if metadataCacheDir is set, on disk up to metadataCacheMaxBytes, evicting the least recently used files.
+        # The cache holds the JSON text, so callers modifying the returned metadata do not modify the cache.
+        # If getMetadata is called without versionId, the latest version of the image set is looked up and reused
+        # for versionCacheSeconds (None to never look it up again), so that cache hits need no request.
+        # Pass versionId to pin a version and skip the lookup.
+        if client is None:
+            session = boto3.Session()
+            client = boto3.client('medical-imaging')
+        self.client = client
+        self.maxFramesInFlight = maxFramesInFlight
+        self.decodeWorkers = decodeWorkers
+        self.decodePool = decodePool
+        self.ownsDecodePool = decodePool is None
+        self.metadataCacheSize = metadataCacheSize
+        self.metadataCacheDir = metadataCacheDir
+        self.metadataCacheMaxBytes = metadataCacheMaxBytes
+        self.metadataCache = OrderedDict()
+        self.metadataCacheHits = 0
+        self.metadataCacheMisses = 0
+        self.versionCacheSeconds = versionCacheSeconds
+        self.latestVersionIds = {}
+        if metadataCacheDir is not None:
+            os.makedirs(metadataCacheDir, exist_ok=True)
     
     def stopwatch(self, start_time, end_time):
         time_lapsed = end_time - start_time
         return time_lapsed*1000 
     
     
-    def getMetadata(self, datastoreId, imageSetId):
+    def getMetadata(self, datastoreId, imageSetId, versionId=None):
         start_time = time.time()
-        dicom_study_metadata = self.client.get_image_set_metadata(datastoreId=datastoreId , imageSetId=imageSetId )
-        json_study_metadata = json.loads( gzip.decompress(dicom_study_metadata["imageSetMetadataBlob"].read()) )
+        if versionId is None:
+            versionId = self.getLatestVersionId(datastoreId, imageSetId)
+        key = (datastoreId, imageSetId, versionId)
+        json_text = self.getCachedMetadata(key)
+        if json_text is not None:
+            self.metadataCacheHits += 1
+            source = "cache"
+        else:
+            self.metadataCacheMisses += 1
+            source = "fetch"
+            dicom_study_metadata = self.client.get_image_set_metadata(datastoreId=datastoreId , imageSetId=imageSetId, versionId=versionId )
+            json_text = gzip.decompress(dicom_study_metadata["imageSetMetadataBlob"].read()).decode("utf-8")
+            self.putCachedMetadata(key, json_text)
+        json_study_metadata = json.loads(json_text)
         end_time = time.time()
-        logging.info(f"Metadata fetch  : {self.stopwatch(start_time,end_time)} ms")   
+        logging.info(f"Metadata {source}  : {self.stopwatch(start_time,end_time)} ms (cache hits {self.metadataCacheHits}, misses {self.metadataCacheMisses})")   
         return json_study_metadata
 
+
+    def getLatestVersionId(self, datastoreId, imageSetId):
+        key = (datastoreId, imageSetId)
+        if key in self.latestVersionIds:
+            versionId, lookup_time = self.latestVersionIds[key]
+            if self.versionCacheSeconds is None or time.time() - lookup_time < self.versionCacheSeconds:
+                return versionId
+        versionId = self.client.get_image_set(datastoreId=datastoreId, imageSetId=imageSetId)["versionId"]
+        self.latestVersionIds[key] = (versionId, time.time())
+        return versionId
+
+
+    def getMetadataCachePath(self, key):
+        return os.path.join(self.metadataCacheDir, "_".join(key) + ".json")
+
+
+    def getCachedMetadata(self, key):
+        if key in self.metadataCache:
+            self.metadataCache.move_to_end(key)
+            return self.metadataCache[key]
+        if self.metadataCacheDir is None:
+            return None
+        path = self.getMetadataCachePath(key)
+        try:
+            with open(path, "r") as f:
+                json_text = f.read()
+        except OSError:
+            return None
+        os.utime(path) # mark as recently used for the eviction
+        self.putCachedMetadata(key, json_text, writeToDisk=False)
+        return json_text
+
+
+    def putCachedMetadata(self, key, json_text, writeToDisk=True):
+        self.metadataCache[key] = json_text
+        self.metadataCache.move_to_end(key)
+        while len(self.metadataCache) > self.metadataCacheSize:
+            self.metadataCache.popitem(last=False)
+        if self.metadataCacheDir is None or not writeToDisk:
+            return
+        path = self.getMetadataCachePath(key)
+        with open(path + ".tmp", "w") as f:
+            f.write(json_text)
+        os.replace(path + ".tmp", path)
+        self.evictMetadataCacheFiles()
+
+
+    def evictMetadataCacheFiles(self):
+        files = [os.path.join(self.metadataCacheDir, name) for name in os.listdir(self.metadataCacheDir) if name.endswith(".json")]
+        files = sorted(((os.stat(path).st_mtime, os.path.getsize(path), path) for path in files), reverse=True)
+        total_bytes = 0
+        for _, size, path in files:
+            total_bytes += size
+            if total_bytes > self.metadataCacheMaxBytes:
+                os.remove(path)
+
     
     def listDatastores(self):
         start_time = time.time()
@@ -98,7 +209,7 @@ class MedicalImaging:
         return response
     
     
-    def getFramePixels(self, datastoreId, imageSetId, imageFrameId):
+    def getFrameBlob(self, datastoreId, imageSetId, imageFrameId):
         start_time = time.time()
         res = self.client.get_image_frame(
             datastoreId=datastoreId,
@@ -106,22 +217,87 @@ class MedicalImaging:
             imageFrameInformation={
                 'imageFrameId': imageFrameId
             })
+        frameBlob = res['imageFrameBlob'].read()
         end_time = time.time()
         logging.debug(f"Frame fetch     : {self.stopwatch(start_time,end_time)} ms") 
-        start_time = time.time() 
-        b = io.BytesIO()
-        b.write(res['imageFrameBlob'].read())
-        b.seek(0)
-        d = decode(b)
-        end_time = time.time()
-        logging.debug(f"Frame decode    : {self.stopwatch(start_time,end_time)} ms")    
+        return frameBlob, self.stopwatch(start_time,end_time)
+
+
+    def getFramePixels(self, datastoreId, imageSetId, imageFrameId):
+        frameBlob, _ = self.getFrameBlob(datastoreId, imageSetId, imageFrameId)
+        d, decode_time = decodeFrame(frameBlob)
+        logging.debug(f"Frame decode    : {decode_time} ms")    
         return d 
 
+
+    def getFrameBlobAndPixels(self, datastoreId, imageSetId, imageFrameId):
+        frameBlob, fetch_time = self.getFrameBlob(datastoreId, imageSetId, imageFrameId)
+        d, decode_time = decodeFrame(frameBlob)
+        return d, fetch_time, decode_time
+
+
+    def getDecodePool(self):
+        if self.decodePool is None and self.decodeWorkers != 0:
+            self.decodePool = ProcessPoolExecutor(max_workers=self.decodeWorkers)
+        return self.decodePool
+
+
+    def close(self):
+        if self.decodePool is not None and self.ownsDecodePool:
+            self.decodePool.shutdown()
+            self.decodePool = None
+
+
+    def getFramesPixels(self, datastoreId, imageSetId, imageFrameIds):
+        # Fetches up to maxFramesInFlight frames concurrently and decodes them in the process pool while
+        # further frames are fetched, or each frame right after its fetch in the fetching thread if decodeWorkers is 0.
+        # The pixels are returned in the order of imageFrameIds. On the first error, all outstanding work is cancelled.
+        start_time = time.time()
+        fetch_time = 0
+        decode_time = 0
+        decode_pool = self.getDecodePool()
+        fetch_pool = ThreadPoolExecutor(max_workers=self.maxFramesInFlight)
+        pixels = [None] * len(imageFrameIds)
+        tasks = {} # future -> (is fetch only, index of the frame)
+        try:
+            for index, imageFrameId in enumerate(imageFrameIds):
+                if decode_pool is None:
+                    tasks[fetch_pool.submit(self.getFrameBlobAndPixels, datastoreId, imageSetId, imageFrameId)] = (False, index)
+                else:
+                    tasks[fetch_pool.submit(self.getFrameBlob, datastoreId, imageSetId, imageFrameId)] = (True, index)
+            pending = set(tasks)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for task in done:
+                    isFetch, index = tasks[task]
+                    if isFetch:
+                        frameBlob, frame_fetch_time = task.result()
+                        fetch_time += frame_fetch_time
+                        decode = decode_pool.submit(decodeFrame, frameBlob)
+                        tasks[decode] = (False, index)
+                        pending.add(decode)
+                    elif decode_pool is None:
+                        pixels[index], frame_fetch_time, frame_decode_time = task.result()
+                        fetch_time += frame_fetch_time
+                        decode_time += frame_decode_time
+                    else:
+                        pixels[index], frame_decode_time = task.result()
+                        decode_time += frame_decode_time
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            fetch_pool.shutdown(wait=False, cancel_futures=True)
+        end_time = time.time()
+        logging.info(f"Frames fetch    : {len(imageFrameIds)} frames, fetch {fetch_time} ms, decode {decode_time} ms, total {self.stopwatch(start_time,end_time)} ms")
+        return pixels
+
+
     def getDICOMdataset(self, datastoreId, imageSetId):
         logging.debug("Reading the JSON metadata file")
         json_dicom_header = self.getMetadata(datastoreId , imageSetId)
 
-        vrlist = []
         sop_instances = []
         
         file_meta = FileMetaDataset()
@@ -130,82 +306,110 @@ class MedicalImaging:
         file_meta.ImplementationClassUID = UID("1.2.826.0.1.3680043.9.3811.2.0.1")
         file_meta.TransferSyntaxUID = UID('1.2.840.10008.1.2.1')  # Made up. Not registered.
         
+        # Patient and Study level elements are the same for all instances, so they are built only once
+        PatientLevel = json_dicom_header["Patient"]["DICOM"]
+        StudyLevel = json_dicom_header["Study"]["DICOM"]
+        sharedElements = self.getDataElements(PatientLevel, {}, {}) + self.getDataElements(StudyLevel, {}, {})
+
         logging.debug("Reading the Pixels")
+        frameIds = []
         for series in json_dicom_header["Study"]["Series"]:
+            planCache = {} # conversion plans are shared by the instances of a series
             for instances in json_dicom_header["Study"]["Series"][series]["Instances"]:
                 ds = Dataset()
                 ds.file_meta = file_meta
                 
-                PatientLevel = json_dicom_header["Patient"]["DICOM"]
-                self.getTags(PatientLevel, ds, vrlist)
-                StudyLevel = json_dicom_header["Study"]["DICOM"]
-                self.getTags(StudyLevel, ds, vrlist)
-                self.getDICOMVRs(json_dicom_header["Study"]["Series"][series]["Instances"][instances]["DICOMVRs"] , vrlist)
-                self.getTags( json_dicom_header["Study"]["Series"][series]["Instances"][instances]["DICOM"] , ds, vrlist)
-                self.getTags(json_dicom_header["Study"]["Series"][series]["DICOM"], ds, vrlist)
+                for data_element in sharedElements:
+                    ds.add(copy.deepcopy(data_element)) # deep copy, such that multi-valued elements are not shared
+                vrdict = self.getDICOMVRs(json_dicom_header["Study"]["Series"][series]["Instances"][instances]["DICOMVRs"])
+                self.getTags( json_dicom_header["Study"]["Series"][series]["Instances"][instances]["DICOM"] , ds, vrdict, planCache)
+                self.getTags(json_dicom_header["Study"]["Series"][series]["DICOM"], ds, vrdict, planCache)
                 
                 ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
                 ds.file_meta.MediaStorageSOPInstanceUID = UID(instances)
                 ds.is_little_endian = True
                 ds.is_implicit_VR = False
                 
-                frameId = json_dicom_header["Study"]["Series"][series]["Instances"][instances]["ImageFrames"][0]["ID"]
-                pixels = self.getFramePixels(datastoreId, json_dicom_header["ImageSetID"], frameId)
-                
-                start_time = time.time()
-                ds.PixelData = pixels.tobytes()
+                frameIds.append(json_dicom_header["Study"]["Series"][series]["Instances"][instances]["ImageFrames"][0]["ID"])
                 sop_instances.append(ds)
-                vrlist.clear()
-                end_time = time.time()
-                logging.debug(f"Outpout save     : {self.stopwatch(start_time,end_time)} ms")     
+
+        framesPixels = self.getFramesPixels(datastoreId, json_dicom_header["ImageSetID"], frameIds)
+        start_time = time.time()
+        for ds, pixels in zip(sop_instances, framesPixels):
+            ds.PixelData = pixels.tobytes()
+        end_time = time.time()
+        logging.debug(f"Outpout save     : {self.stopwatch(start_time,end_time)} ms")     
         return sop_instances
     
-    def getDICOMVRs(self, taglevel, vrlist):
-        for theKey in taglevel:
-            vrlist.append( [ theKey , taglevel[theKey] ])
-            logging.debug(f"[getDICOMVRs] - List of private tags VRs: {vrlist}\r\n")
+    def getDICOMVRs(self, taglevel, vrdict=None):
+        # Maps the keys of private tags to their VRs. If a key is listed twice, the last VR wins.
+        if vrdict is None:
+            vrdict = {}
+        vrdict.update(taglevel)
+        logging.debug(f"[getDICOMVRs] - List of private tags VRs: {vrdict}\r\n")
+        return vrdict
 
 
-    def getTags(self, tagLevel, ds, vrlist):    
+    def getTagVR(self, theKey, vrdict):
+        if theKey not in dictionaryVRs:
+            try:
+                dictionaryVRs[theKey] = pydicom.datadict.dictionary_VR(theKey)
+            except:  #In case the vr is not in the pydicom dictionnary, it might be a private tag , listed in the vrdict
+                dictionaryVRs[theKey] = None
+        tagvr = dictionaryVRs[theKey]
+        if tagvr is None:
+            tagvr = vrdict.get(theKey)
+        return tagvr
+
+
+    def getTagPlan(self, tagLevel, vrdict, planCache):
+        # Conversion plan for a set of keys: a list of (key, VR) for the keys to be added to a dataset. Keys to skip,
+        # sequences and tags of group 2 or of odd (private) groups are left out. Plans are cached by keys and private VRs.
+        cacheKey = (tuple(tagLevel.keys()), tuple(vrdict.items()))
+        if cacheKey in planCache:
+            return planCache[cacheKey]
+        plan = []
         for theKey in tagLevel:
             if theKey in ['PrivateCreatorID', 'FileMetaInformationVersion', '00291203']:
                 continue
+            tagvr = self.getTagVR(theKey, vrdict)
+            if(tagvr == 'SQ'):
+                # sequences are not added to the dataset
+                logging.debug(f"{theKey} : {tagLevel[theKey]} , {vrdict}")
+                continue
+            try:
+                group = Tag(theKey).group
+            except Exception as err:
+                logging.warning(f"[HLIDataDICOMizer][getTags] - {err} for Key: {theKey}")
+                continue
+            if group != 2 and (int(group) % 2) == 0 : # we are skipping all the private tags
+                plan.append((theKey, tagvr))
+        planCache[cacheKey] = plan
+        return plan
+
+
+    def getDataElements(self, tagLevel, vrdict, planCache):
+        data_elements = []
+        for theKey, tagvr in self.getTagPlan(tagLevel, vrdict, planCache):
             try:
-                try:
-                    tagvr = pydicom.datadict.dictionary_VR(theKey)
-                except:  #In case the vr is not in the pydicom dictionnary, it might be a private tag , listed in the vrlist
-                    tagvr = None
-                    for vr in vrlist:
-                        if theKey == vr[0]:
-                            tagvr = vr[1]
                 datavalue=tagLevel[theKey]
-                #print(f"{tagvr} {theKey} : {datavalue}")
-                if(tagvr == 'SQ'):
-                    logging.debug(f"{theKey} : {tagLevel[theKey]} , {vrlist}")
-                    seqs = []
-                    for underSeq in tagLevel[theKey]:
-                        seqds = Dataset()
-                        self.getTags(underSeq, seqds, vrlist)
-                        seqs.append(seqds)
-                    datavalue = Sequence(seqs)
-                    continue
                 if(tagvr == 'US or SS'):
-                    datavalue=tagLevel[theKey]
                     if (int(datavalue) > 32767):
                         tagvr = 'US'
                 if( tagvr == 'OB'):
-                    datavalue = self.getOBVRTagValue(tagLevel[theKey] )
-                    
-                data_element = DataElement(theKey , tagvr , datavalue )
-                if data_element.tag.group != 2:
-                    try:
-                        if (int(data_element.tag.group) % 2) == 0 : # we are skipping all the private tags
-                            ds.add(data_element) 
-                    except:
-                        continue
+                    datavalue = self.getOBVRTagValue(datavalue)
+                data_elements.append(DataElement(theKey , tagvr , datavalue ))
             except Exception as err:
                 logging.warning(f"[HLIDataDICOMizer][getTags] - {err} for Key: {theKey}")
                 continue 
+        return data_elements
+
+
+    def getTags(self, tagLevel, ds, vrdict, planCache=None):    
+        if not isinstance(vrdict, dict): # list of [key, VR] pairs
+            vrdict = dict(vrdict)
+        for data_element in self.getDataElements(tagLevel, vrdict, {} if planCache is None else planCache):
+            ds.add(data_element) 
 
 
 
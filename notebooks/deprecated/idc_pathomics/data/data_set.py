@@ -2,10 +2,12 @@ import csv
 import os
 import random
 import numpy as np
+import tensorflow as tf
 from tensorflow.keras.utils import to_categorical
-from typing import Tuple, Generator
+from typing import Tuple, Generator, List
 
 from .data_point import DataPoint
+from . import shards
 
 
 class Dataset:
@@ -13,6 +15,7 @@ class Dataset:
     def __init__(self, csv_file: str, num_classes: int) -> None:
         self.num_classes = num_classes
         self.data_points = []
+        self.shards = [] # (path, reference_value) of shards holding all tiles of a slide, see shards.py
         
         base_path = os.path.abspath(os.path.split(csv_file)[0])
         with open(csv_file, mode='r') as f:
@@ -22,18 +25,27 @@ class Dataset:
                     reference_value = [int(x) for x in entry['reference_value'].split(';')]
                 else: 
                     reference_value = int(entry['reference_value'])
+                if shards.is_shard(entry['path']):
+                    self.shards.append((os.path.join(base_path, entry['path']), reference_value))
+                    continue
                 self.data_points.append(DataPoint(
                         os.path.join(base_path, entry['path']), 
                         reference_value
                     ))
                     
-        self.patch_width, self.patch_height, self.num_channels = self.data_points[0].get_patch().shape
+        if self.data_points:
+            self.patch_width, self.patch_height, self.num_channels = self.data_points[0].get_patch().shape
+        else:
+            self.patch_width, self.patch_height, self.num_channels = shards.read_first_tile(self.shards[0][0]).shape
+        self.num_shard_tiles = sum(shards.get_number_of_tiles(path) for (path, _) in self.shards)
         
 
     def __len__(self) -> int:
-        return len(self.data_points)
+        return len(self.data_points) + self.num_shard_tiles
 
     def get_generator(self, batch_size: int = 1, infinite: bool = False, shuffle: bool = False) -> Generator[Tuple[np.ndarray, np.ndarray], None, None]: 
+        if self.shards:
+            raise ValueError('Tiles stored in shards can only be read with get_tf_dataset.')
         indices = list(range(len(self.data_points)))
         while True:
             if shuffle:
@@ -64,6 +76,103 @@ class Dataset:
             if not infinite:
                 break
 
+    def get_tf_dataset(self, batch_size: int = 1, infinite: bool = False, shuffle: bool = False, cache: bool = False, shuffle_buffer_size: int = 10000) -> tf.data.Dataset:
+        # Same batches as get_generator, but JPEG decoding runs in parallel inside the tf.data pipeline.
+        # Files and shards are shuffled before caching, such that the cache holds them in random order instead of 
+        # the slide-grouped order of the CSV file. Later epochs replay the cached order, reshuffled by the shuffle buffer.
+        dataset = self._get_encoded_tf_dataset(shuffle=shuffle)
+        if cache: # cache the encoded JPEGs, decoded tiles would need several times the memory
+            dataset = dataset.cache()
+        if shuffle:
+            dataset = dataset.shuffle(min(shuffle_buffer_size, len(self)), reshuffle_each_iteration=True)
+        dataset = dataset.map(self._decode_patch, num_parallel_calls=tf.data.AUTOTUNE)
+        dataset = dataset.batch(batch_size, drop_remainder=True)
+        if infinite:
+            dataset = dataset.repeat()
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def _get_encoded_tf_dataset(self, shuffle: bool) -> tf.data.Dataset:
+        # Yields (encoded JPEG, label) of all tiles. Shuffling here only shuffles the order of files and shards.
+        # As a shard holds all tiles of one slide, shuffled shards still yield tiles of only as many slides at a time 
+        # as are interleaved (cycle_length, by default the number of CPU cores), so batches are less well mixed 
+        # than with individual tile files unless the shuffle buffer in get_tf_dataset spans several slides.
+        datasets = []
+        if self.data_points:
+            paths = [data_point.patch_path for data_point in self.data_points]
+            labels = self._get_labels([data_point.get_reference_value() for data_point in self.data_points])
+            dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+            if shuffle:
+                dataset = dataset.shuffle(len(paths), reshuffle_each_iteration=True)
+            datasets.append(dataset.map(lambda path, label: (tf.io.read_file(path), label), num_parallel_calls=tf.data.AUTOTUNE))
+        if self.shards:
+            paths = [path for (path, _) in self.shards]
+            labels = self._get_labels([reference_value for (_, reference_value) in self.shards])
+            dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+            if shuffle:
+                dataset = dataset.shuffle(len(paths), reshuffle_each_iteration=True)
+            datasets.append(dataset.interleave(
+                lambda path, label: tf.data.TFRecordDataset(path).map(lambda record: (shards.parse_tile(record)['image'], label)),
+                num_parallel_calls=tf.data.AUTOTUNE, 
+                deterministic=not shuffle))
+        dataset = datasets[0]
+        for other_dataset in datasets[1:]:
+            dataset = dataset.concatenate(other_dataset)
+        return dataset
+
+    def get_prediction_tf_dataset(self, batch_size: int = 256) -> tf.data.Dataset:
+        # Yields batches of (patches, indices) of all tiles, without shuffling or dropping the last partial batch. 
+        # The index of a tile refers to its position in get_tile_info, which allows to read the shards in parallel.
+        datasets = []
+        if self.data_points:
+            paths = [data_point.patch_path for data_point in self.data_points]
+            dataset = tf.data.Dataset.from_tensor_slices((paths, np.arange(len(paths), dtype=np.int64)))
+            datasets.append(dataset.map(lambda path, index: (tf.io.read_file(path), index), num_parallel_calls=tf.data.AUTOTUNE))
+        if self.shards:
+            paths = [path for (path, _) in self.shards]
+            offsets = len(self.data_points) + np.cumsum([0] + [shards.get_number_of_tiles(path) for path in paths[:-1]], dtype=np.int64)
+            dataset = tf.data.Dataset.from_tensor_slices((paths, offsets))
+            datasets.append(dataset.interleave(
+                lambda path, offset: tf.data.TFRecordDataset(path).enumerate().map(
+                    lambda i, record: (shards.parse_tile(record)['image'], offset + i)),
+                num_parallel_calls=tf.data.AUTOTUNE, 
+                deterministic=False))
+        dataset = datasets[0]
+        for other_dataset in datasets[1:]:
+            dataset = dataset.concatenate(other_dataset)
+        dataset = dataset.map(self._decode_patch, num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+    def get_tile_info(self) -> Tuple[np.ndarray, np.ndarray, List]:
+        # Slide IDs, tile positions (col, row) and reference values of all tiles, tiles of data points first, then those of the shards
+        slide_ids = [data_point.get_slide_id() for data_point in self.data_points]
+        tile_positions = [data_point.get_position() for data_point in self.data_points]
+        reference_values = [data_point.get_reference_value() for data_point in self.data_points]
+        for (path, reference_value) in self.shards:
+            index = shards.read_shard_index(path)
+            slide_ids.extend([shards.get_slide_id_from_shard_path(path)] * len(index))
+            tile_positions.extend(index[['col', 'row']].to_numpy().tolist())
+            reference_values.extend([reference_value] * len(index))
+        tile_positions = np.asarray(tile_positions, dtype=np.int32).reshape(-1, 2)
+        return np.asarray(slide_ids, dtype=object), tile_positions, reference_values
+
+    def _get_labels(self, reference_values: list) -> np.ndarray:
+        if self.num_classes == 2:
+            return np.asarray(reference_values, dtype=np.float32)
+        elif self.num_classes == 3:
+            # generate one-hot-encoding for the reference
+            return np.eye(3, dtype=np.float32)[reference_values]
+        elif self.num_classes == 10:
+            # generate k-hot-encoding for the reference
+            labels = np.zeros((len(reference_values), 10), dtype=np.float32)
+            for i, reference_value in enumerate(reference_values):
+                np.add.at(labels[i], reference_value, 1)
+            return labels
+
+    def _decode_patch(self, encoded_patch: tf.Tensor, label: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+        patch = tf.io.decode_jpeg(encoded_patch, channels=self.num_channels, dct_method='INTEGER_ACCURATE')
+        patch = tf.ensure_shape(patch, (self.patch_width, self.patch_height, self.num_channels))
+        return (tf.cast(patch, tf.float32) / 127.5) - 1.0, label # Scale to [-1, 1], expected input for InceptionV3 network
+
     def to_k_hot_encoding(self, data_point: DataPoint) -> np.ndarray:
         one_hot_in_lines = to_categorical(data_point.get_reference_value(), num_classes=10)
         k_hot = one_hot_in_lines.sum(axis=0)
@@ -0,0 +1,160 @@
+import io
+import os
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict
+from urllib.parse import urlparse
+from upath import UPath
+from wsidicom import WsiDicom
+from wsidicom.file import WsiDicomFileSource
+from wsidicom.file.io import WsiDicomReadIO
+
+# Read-only, seekable file objects that fetch byte ranges on demand instead of downloading whole files.
+# WsiDicom only reads the DICOM header, the frame offset table and the frames it needs, so opening a slide
+# through a RangeFile (see open_range_slide) transfers a small fraction of a multi-gigabyte file, e.g. when
+# only the thumbnail is read.
+
+
+class RangeSource(ABC):
+    # Interface of a byte source, see LocalFileSource and HttpRangeSource
+
+    @abstractmethod
+    def get_size(self) -> int:
+        pass
+
+    @abstractmethod
+    def read_range(self, start: int, length: int) -> bytes:
+        pass
+
+
+class LocalFileSource(RangeSource):
+    # Local stand-in for remote sources, e.g. for testing
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def get_size(self) -> int:
+        return os.path.getsize(self.path)
+
+    def read_range(self, start: int, length: int) -> bytes:
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            return f.read(length)
+
+
+class HttpRangeSource(RangeSource):
+
+    def __init__(self, url: str, headers: Dict[str, str] = None) -> None:
+        import requests
+        self.url = url
+        self.headers = headers or {}
+        self._session = requests.Session()
+        self._size = None
+
+    def get_size(self) -> int:
+        if self._size is None:
+            response = self._session.head(self.url, headers=self.headers, allow_redirects=True)
+            response.raise_for_status()
+            self._size = int(response.headers['Content-Length'])
+        return self._size
+
+    def read_range(self, start: int, length: int) -> bytes:
+        headers = dict(self.headers, Range='bytes=%d-%d' % (start, start + length - 1))
+        response = self._session.get(self.url, headers=headers)
+        response.raise_for_status()
+        # A server ignoring the Range header returns the whole file with status 200 instead of 206 Partial Content
+        if response.status_code != 206:
+            raise IOError('Range request to %s returned status %d instead of 206.' % (self.url, response.status_code))
+        return response.content
+
+
+def get_gcs_range_source(gcs_url: str, google_cloud_project_id: str) -> HttpRangeSource:
+    # Access gs://bucket/object through the path-style XML API endpoint, billing requester-pays buckets to the given project
+    import google.auth
+    import google.auth.transport.requests
+    credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/devstorage.read_only'])
+    credentials.refresh(google.auth.transport.requests.Request())
+    parsed_url = urlparse(gcs_url)
+    url = 'https://storage.googleapis.com/{bucket}{object}?userProject={id}'.format(
+        bucket=parsed_url.netloc, object=parsed_url.path, id=google_cloud_project_id)
+    return HttpRangeSource(url, headers={'Authorization': 'Bearer ' + credentials.token})
+
+
+class RangeFile(io.RawIOBase):
+    # Reads go through a cache of fixed-size blocks, such that the many small reads of a DICOM parser
+    # result in few range requests
+
+    def __init__(self, source: RangeSource, block_size: int = 1024 * 1024, max_cached_blocks: int = 64) -> None:
+        super().__init__()
+        self.source = source
+        self.block_size = block_size
+        self.max_cached_blocks = max_cached_blocks
+        self.size = source.get_size()
+        self.bytes_fetched = 0
+        self._position = 0
+        self._blocks = OrderedDict()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError('Invalid whence %s' % whence)
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast('B')
+        length = max(0, min(len(view), self.size - self._position))
+        written = 0
+        while written < length:
+            block_index, block_offset = divmod(self._position, self.block_size)
+            block = self._get_block(block_index)
+            n = min(length - written, len(block) - block_offset)
+            view[written:written + n] = block[block_offset:block_offset + n]
+            written += n
+            self._position += n
+        return written
+
+    def _get_block(self, block_index: int) -> bytes:
+        if block_index in self._blocks:
+            self._blocks.move_to_end(block_index)
+            return self._blocks[block_index]
+        start = block_index * self.block_size
+        block = self.source.read_range(start, min(self.block_size, self.size - start))
+        self.bytes_fetched += len(block)
+        self._blocks[block_index] = block
+        if len(self._blocks) > self.max_cached_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+
+def open_range_file(location: str, google_cloud_project_id: str = None) -> io.BufferedReader:
+    # Supports gs:// and http(s):// URLs as well as local paths
+    if location.startswith('gs://'):
+        source = get_gcs_range_source(location, google_cloud_project_id)
+    elif location.startswith('http://') or location.startswith('https://'):
+        source = HttpRangeSource(location)
+    else:
+        source = LocalFileSource(location)
+    return io.BufferedReader(RangeFile(source))
+
+
+def open_range_slide(location: str, google_cloud_project_id: str = None) -> WsiDicom:
+    # WsiDicom.open only accepts paths, so the range file is passed through wsidicom's stream-level API instead.
+    # wsidicom uses the path of a stream for messages and to reopen local files with a larger buffer, so a
+    # non-local placeholder path keeps all reads on the range file.
+    placeholder_path = UPath('memory:///' + location.split('://')[-1].lstrip('/'))
+    stream = WsiDicomReadIO(open_range_file(location, google_cloud_project_id), filepath=placeholder_path)
+    return WsiDicom(WsiDicomFileSource([stream]), source_owned=True)
@@ -0,0 +1,33 @@
+import os
+import pandas as pd
+
+# File layout of shards, see shards.py. Kept apart from shards.py, which imports TensorFlow, such that
+# tile generation and sorting do not load TensorFlow. Next to a shard [SLIDE-ID].tfrecord, an index file
+# [SLIDE-ID].index.csv lists col and row of every record, so tiles can be counted without reading the shard.
+
+SHARD_EXTENSION = '.tfrecord'
+INDEX_EXTENSION = '.index.csv'
+
+
+def is_shard(path: str) -> bool:
+    return path.endswith(SHARD_EXTENSION)
+
+
+def get_shard_path(output_folder: str, slide_id: str) -> str:
+    return os.path.join(output_folder, slide_id + SHARD_EXTENSION)
+
+
+def get_index_path(shard_path: str) -> str:
+    return shard_path[:-len(SHARD_EXTENSION)] + INDEX_EXTENSION
+
+
+def get_slide_id_from_shard_path(shard_path: str) -> str:
+    return os.path.basename(shard_path)[:-len(SHARD_EXTENSION)]
+
+
+def read_shard_index(shard_path: str) -> pd.DataFrame:
+    return pd.read_csv(get_index_path(shard_path))
+
+
+def get_number_of_tiles(shard_path: str) -> int:
+    return len(read_shard_index(shard_path))
@@ -0,0 +1,79 @@
+import os
+import io
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from PIL.Image import Image
+from typing import Dict
+
+from .shard_paths import SHARD_EXTENSION, INDEX_EXTENSION, is_shard, get_shard_path, get_index_path, get_slide_id_from_shard_path, read_shard_index, get_number_of_tiles
+
+# A shard holds all tiles of one slide as sequential TFRecords. Every record embeds the JPEG-encoded tile
+# together with slide_id, col, row and label (-1 if not yet known). The paths of a shard and of its index
+# file are defined in shard_paths.py.
+
+TILE_FEATURES = {
+    'image': tf.io.FixedLenFeature([], tf.string),
+    'slide_id': tf.io.FixedLenFeature([], tf.string),
+    'col': tf.io.FixedLenFeature([], tf.int64),
+    'row': tf.io.FixedLenFeature([], tf.int64),
+    'label': tf.io.FixedLenFeature([], tf.int64)
+}
+
+
+class ShardWriter:
+    # Writes to temporary files that are only renamed on a successful close, such that an interrupted
+    # run never leaves a partial shard behind
+
+    def __init__(self, shard_path: str, slide_id: str, label: int = -1) -> None:
+        self.shard_path = shard_path
+        self.slide_id = slide_id
+        self.label = label
+        self.positions = []
+        self._writer = tf.io.TFRecordWriter(shard_path + '.tmp')
+
+    def write(self, tile: Image, col: int, row: int, quality: int = 90) -> None:
+        encoded_tile = io.BytesIO()
+        tile.save(encoded_tile, format='jpeg', quality=quality)
+        self._writer.write(_serialize_tile(encoded_tile.getvalue(), self.slide_id, col, row, self.label))
+        self.positions.append((col, row))
+
+    def close(self) -> None:
+        self._writer.close()
+        index_path = get_index_path(self.shard_path)
+        pd.DataFrame(self.positions, columns=['col', 'row']).to_csv(index_path + '.tmp', index=False)
+        os.replace(index_path + '.tmp', index_path)
+        os.replace(self.shard_path + '.tmp', self.shard_path)
+
+    def abort(self) -> None:
+        self._writer.close()
+        os.remove(self.shard_path + '.tmp')
+
+    def __enter__(self) -> 'ShardWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _serialize_tile(encoded_tile: bytes, slide_id: str, col: int, row: int, label: int) -> bytes:
+    feature = {
+        'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[encoded_tile])),
+        'slide_id': tf.train.Feature(bytes_list=tf.train.BytesList(value=[slide_id.encode()])),
+        'col': tf.train.Feature(int64_list=tf.train.Int64List(value=[col])),
+        'row': tf.train.Feature(int64_list=tf.train.Int64List(value=[row])),
+        'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[label]))
+    }
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+def parse_tile(record: tf.Tensor) -> Dict[str, tf.Tensor]:
+    return tf.io.parse_single_example(record, TILE_FEATURES)
+
+
+def read_first_tile(shard_path: str) -> np.ndarray:
+    record = next(iter(tf.data.TFRecordDataset(shard_path)))
+    return tf.io.decode_jpeg(parse_tile(record)['image'], channels=3).numpy()
@@ -8,15 +8,24 @@ from wsidicom import WsiDicom
 from pydicom import config 
 config.enforce_valid_values = False
 from wsidicom.geometry import SizeMm
+import shutil
 import subprocess
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from typing import Tuple
+from typing import Dict, Iterator, Tuple
+
+from .shard_paths import get_shard_path, get_index_path
+from .tiling_manifest import TilingManifest, MANIFEST_FILENAME
+from .range_file import open_range_slide
  
 
 
-def generate_tiles(slides_folder: str, metadata_path: str, output_folder: str, google_cloud_project_id: str, pixel_spacing: float=2.1, tile_size: int=128, every_xth_tile: int=1) -> None:
+def generate_tiles(slides_folder: str, metadata_path: str, output_folder: str, google_cloud_project_id: str, pixel_spacing: float=2.1, tile_size: int=128, every_xth_tile: int=1, output_format: str='jpeg', num_workers: int=1, max_staged_slides: int=None, range_reads: bool=False) -> pd.DataFrame:
     """ 
-    Run tiling for each slide separately. If tiles for the respective slide are already present, the slide is skipped. 
+    Run tiling for each slide separately. If the respective slide has already been tiled with the same parameters according to the 
+    manifest tiling_manifest.sqlite in the output folder, the slide is skipped. Tiles of interrupted runs or other parameters are replaced. 
+    Slides are downloaded in background threads while up to num_workers slides are tiled in parallel worker processes. 
     Args:
         slides_folder (str): absolute path to the folder containing the slides. 
         metadata_path (str): absolute path to the metadata file. 
@@ -25,70 +34,156 @@ def generate_tiles(slides_folder: str, metadata_path: str, output_folder: str, g
         pixel_spacing (float): required pixel spacing in µm/px e.g. 2.1 for 5x resolution. Default 2.1. 
         tile_size (int): required tile size of the quadratic tiles in px e.g. 128. Default 128. 
         every_xth_tile (int): don't look at every tile, but only every x-th one. Should be set to 1 if all tiles should be considered. Default: 1. 
+        output_format (str): 'jpeg' to store one JPEG file per tile in a subfolder per slide or 'tfrecord' to store all tiles of a slide 
+            sequentially in one shard [SLIDE-ID].tfrecord plus an index file [SLIDE-ID].index.csv, see shards.py. Default: 'jpeg'.
+        num_workers (int): number of worker processes tiling slides in parallel. Default: 1. 
+        max_staged_slides (int): maximum number of slides stored in slides_folder at the same time, i.e. downloaded or being downloaded 
+            and not yet tiled. Default: num_workers + 1. 
+        range_reads (bool): read the slides directly from Google Cloud Storage with byte-range requests, fetching only the parts 
+            of the file needed for tiling, instead of downloading them with gsutil. Default: False. 
     Returns:
-        None
+        pd.DataFrame: one record per slide with columns slide_id, status ('tiled', 'skipped' or 'failed'), error and duration in seconds. 
+            The records are also stored as tiling_log.csv in the output folder. 
     """
 
+    if output_format not in ['jpeg', 'tfrecord']:
+        raise ValueError('Please specify a valid output format.')
+
     if not os.path.exists(slides_folder):
         os.makedirs(slides_folder)
 
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
+    if max_staged_slides is None:
+        max_staged_slides = num_workers + 1
+
     slides_metadata = pd.read_csv(metadata_path)
     num_slides = len(slides_metadata)
-    for idx, row in slides_metadata.iterrows():
-        print('%s/%s' %(idx+1, num_slides))
-        path_to_slide = _get_path_to_slide_from_gcs_url(row['gcs_url'], slides_folder) 
-        slide_id = row['slide_id']
-        gcs_url = row['gcs_url']
-        _generate_tiles_for_slide(path_to_slide, slide_id, gcs_url, output_folder, google_cloud_project_id, pixel_spacing, tile_size, every_xth_tile)
-
-
-def _generate_tiles_for_slide(path_to_slide: str, slide_id: str, gcs_url: str, output_folder: str, google_cloud_project_id: str, pixel_spacing: float, tile_size: int, every_xth_tile: int) -> None:
-    # Check if slide is already tiled
-    output_dir_tiles = os.path.join(output_folder, slide_id) 
-    if os.path.exists(output_dir_tiles):
+    manifest = TilingManifest(os.path.join(output_folder, MANIFEST_FILENAME))
+    parameters = {'pixel_spacing': pixel_spacing, 'tile_size': tile_size, 'every_xth_tile': every_xth_tile, 'output_format': output_format}
+    download = not range_reads
+
+    # Every download thread stages one slide at a time and waits until the slide is tiled and deleted, 
+    # such that the number of download threads bounds the number of slides on local disk
+    with ThreadPoolExecutor(max_workers=max_staged_slides) as download_pool, ProcessPoolExecutor(max_workers=num_workers) as tiling_pool:
+        futures = []
+        for idx, row in slides_metadata.iterrows():
+            path_to_slide = _get_path_to_slide_from_gcs_url(row['gcs_url'], slides_folder) 
+            futures.append(download_pool.submit(_generate_tiles_for_slide, path_to_slide, row['slide_id'], row['gcs_url'], output_folder, 
+                                                google_cloud_project_id, manifest, parameters, tiling_pool, download))
+        records = []
+        for idx, future in enumerate(futures):
+            records.append(future.result())
+            print('%s/%s' %(idx+1, num_slides))
+
+    tiling_log = pd.DataFrame(records, columns=['slide_id', 'status', 'error', 'duration'])
+    tiling_log.to_csv(os.path.join(output_folder, 'tiling_log.csv'), index=False)
+    return tiling_log
+
+
+def _generate_tiles_for_slide(path_to_slide: str, slide_id: str, gcs_url: str, output_folder: str, google_cloud_project_id: str, manifest: TilingManifest, parameters: Dict[str, object], tiling_pool: Executor=None, download: bool=True) -> Dict[str, object]:
+    start_time = time.time()
+    # Check if slide is already tiled with the same parameters
+    if manifest.is_tiled(slide_id, parameters):
         print('Slide %s already downloaded and tiled' % slide_id)
-        return
+        return {'slide_id': slide_id, 'status': 'skipped', 'error': '', 'duration': 0.0}
+    # Remove tiles of an interrupted run or a run with other parameters
+    _remove_tiles(output_folder, slide_id)
+    manifest.set_status(slide_id, 'started', parameters)
     
-    # Download slide in DICOM format using gsutil
-    print('Downloading slide %s - %s' %(slide_id, datetime.now()))
-    cmd = ['gsutil -u {id} cp {url} {local_dir}'.format(id=google_cloud_project_id, url=gcs_url, local_dir=os.path.dirname(path_to_slide))]
-    subprocess.run(cmd, shell=True)
+    if download:
+        # Download slide in DICOM format using gsutil
+        print('Downloading slide %s - %s' %(slide_id, datetime.now()))
+        cmd = ['gsutil -u {id} cp {url} {local_dir}'.format(id=google_cloud_project_id, url=gcs_url, local_dir=os.path.dirname(path_to_slide))]
+        subprocess.run(cmd, shell=True)
+        slide_location = path_to_slide
+    else:
+        slide_location = gcs_url
+
+    tile_args = (slide_location, slide_id, output_folder, parameters['pixel_spacing'], parameters['tile_size'], parameters['every_xth_tile'], parameters['output_format'], google_cloud_project_id)
+    try:
+        if tiling_pool is None:
+            num_tiles = _tile_slide(*tile_args)
+        else:
+            num_tiles = tiling_pool.submit(_tile_slide, *tile_args).result()
+        status, error = 'tiled', ''
+        manifest.set_status(slide_id, status, parameters, num_tiles)
+    except Exception as e: 
+        print('Some processing error for slide %s. Moving to the next slide.' %(slide_id))
+        status, error = 'failed', repr(e)
+        _remove_tiles(output_folder, slide_id) # do not leave partial tiles behind
+        manifest.set_status(slide_id, status, parameters)
+    finally:
+        # After tiling delete the WSI to save disk space
+        if os.path.exists(path_to_slide):
+            os.remove(path_to_slide)
+    return {'slide_id': slide_id, 'status': status, 'error': error, 'duration': time.time() - start_time}
 
+
+def _tile_slide(slide_location: str, slide_id: str, output_folder: str, pixel_spacing: float, tile_size: int, every_xth_tile: int, output_format: str, google_cloud_project_id: str=None) -> int:
     # Open slide and find the level closest to the required pixel spacing  
     print('Processing slide %s - %s' %(slide_id, datetime.now()))
-
-    try:
-        slide = WsiDicom.open(path_to_slide)
-        level = _get_closest_level_by_pixel_spacing(slide, pixel_spacing) 
-    except: 
-        print('Some processing error for slide %s. Moving to the next slide.' %(slide_id))
-        os.remove(path_to_slide)
-        return 
+    slide = open_slide(slide_location, google_cloud_project_id)
+    level = _get_closest_level_by_pixel_spacing(slide, pixel_spacing) 
     
     # Tiling 
-    os.makedirs(output_dir_tiles) 
+    num_tiles = 0
+    if output_format == 'tfrecord':
+        from .shards import ShardWriter # imports TensorFlow, which is only needed for shards
+        with ShardWriter(get_shard_path(output_folder, slide_id), slide_id) as shard_writer:
+            for (col, row, tile) in _iterate_foreground_tiles(slide, level, tile_size, every_xth_tile):
+                shard_writer.write(tile, col, row, quality=90)
+                num_tiles += 1
+    else:
+        output_dir_tiles = os.path.join(output_folder, slide_id) 
+        os.makedirs(output_dir_tiles) 
+        for (col, row, tile) in _iterate_foreground_tiles(slide, level, tile_size, every_xth_tile):
+            tile.save(os.path.join(output_dir_tiles, '%d_%d.%s' %(col, row, 'jpeg')), quality=90)
+            num_tiles += 1
+    return num_tiles
+
+
+def _remove_tiles(output_folder: str, slide_id: str) -> None:
+    output_dir_tiles = os.path.join(output_folder, slide_id) 
+    if os.path.exists(output_dir_tiles):
+        shutil.rmtree(output_dir_tiles)
+    shard_path = get_shard_path(output_folder, slide_id)
+    for path in [shard_path, get_index_path(shard_path)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _iterate_foreground_tiles(slide: WsiDicom, level: int, tile_size: int, every_xth_tile: int, chunk_size: int=64) -> Iterator[Tuple[int, int, Image]]:
     cols, rows = _get_nr_cols_and_rows(slide, level) # get number of tiles in this level as (nr_tiles_xAxis, nr_tiles_yAxis)
     
     tuples = [(row,col) for row in range(1, rows) for col in range(1, cols)] # skip first row and colum (always background) 
-    for (row, col) in tuples[::every_xth_tile]:
-        tilename = os.path.join(output_dir_tiles, '%d_%d.%s' %(col, row, 'jpeg'))
-        if not os.path.exists(tilename):
+    tuples = tuples[::every_xth_tile]
+    for i in range(0, len(tuples), chunk_size):
+        positions, tiles = [], []
+        for (row, col) in tuples[i:i+chunk_size]:
             wsidicom_tile = slide.read_tile(level, tile=(col, row)) 
             if wsidicom_tile.size[0] == wsidicom_tile.size[1]: # only consider quadratic tiles
                 if (wsidicom_tile.size[0] != tile_size): 
                     tile = wsidicom_tile.resize((tile_size,tile_size))
                 else: 
                     tile = wsidicom_tile
-                # only store tile if there is enough amount of information, i.e. < 50 % background and the tile size is alright
-                avg_bkg = _get_amount_of_background(tile)
-                if avg_bkg <= 0.5:  
-                    tile.save(tilename, quality=90)
+                positions.append((col, row))
+                tiles.append(tile)
+        if not tiles:
+            continue
+        # only store tile if there is enough amount of information, i.e. < 50 % background and the tile size is alright
+        avg_bkgs = get_background_fractions(np.stack([np.asarray(tile.convert(mode='RGB')) for tile in tiles]))
+        for (col, row), tile, avg_bkg in zip(positions, tiles, avg_bkgs):
+            if avg_bkg <= 0.5:  
+                yield (col, row, tile)
 
-    # After tiling delete the WSI to save disk space
-    os.remove(path_to_slide)
+
+def open_slide(slide_location: str, google_cloud_project_id: str=None) -> WsiDicom:
+    # Local files are opened directly, gs:// and http(s):// URLs through byte-range reads
+    if slide_location.startswith('gs://') or slide_location.startswith('http://') or slide_location.startswith('https://'):
+        return open_range_slide(slide_location, google_cloud_project_id)
+    return WsiDicom.open(slide_location)
 
 
 def _get_path_to_slide_from_gcs_url(gcs_url: str, slides_folder: str) -> str:
@@ -110,8 +205,17 @@ def _get_nr_cols_and_rows(slide: WsiDicom, level: int) -> Tuple[int, int]:
     return (int(cols), int(rows))
 
 
-def _get_amount_of_background(tile: Image) -> float:
-    grey = tile.convert(mode='L') 
-    thresholded = grey.point(lambda x: 0 if x < 220 else 1, mode='F') 
-    avg_bkg = np.average(np.array(thresholded))
-    return avg_bkg   
\ No newline at end of file
+def get_background_fractions(tiles: np.ndarray, threshold: int=220, downsample: int=1) -> np.ndarray:
+    """ 
+    Computes the fraction of background pixels, i.e. pixels with a grey value >= threshold, for a stack of tiles in one vectorized pass. 
+    The grey values are computed like PIL's conversion to mode 'L', such that results are identical to thresholding tile.convert(mode='L').
+    Args:
+        tiles (np.ndarray): uint8 RGB(A) tiles of shape (N, H, W, C) or a single tile of shape (H, W, C). 
+        threshold (int): grey value from which on a pixel is considered as background. Default: 220. 
+        downsample (int): only consider every downsample-th pixel along both axes. Default: 1. 
+    Returns:
+        np.ndarray: background fraction per tile of shape (N,), or a 0-d array for a single tile. 
+    """
+    tiles = np.asarray(tiles)[..., ::downsample, ::downsample, :3].astype(np.uint32)
+    grey = (tiles[..., 0] * 19595 + tiles[..., 1] * 38470 + tiles[..., 2] * 7471 + 0x8000) >> 16 # ITU-R 601-2 luma as in PIL
+    return (grey >= threshold).mean(axis=(-2, -1))
@@ -2,9 +2,11 @@ import os
 from glob import glob
 from collections import defaultdict
 import pandas as pd
-from typing import Dict
+from typing import Dict, Optional
 
 from .utils import get_slide_tissue_type
+from . import shard_paths
+from .tiling_manifest import TilingManifest, MANIFEST_FILENAME
 
 SORTING_OPTIONS = {'norm_cancer': {'normal':0, 'luad':1, 'lscc':1}, 'luad_lscc': {'luad':0, 'lscc':1}, 'norm_luad_lscc': {'normal':0, 'luad':1, 'lscc':2}}
 
@@ -61,11 +63,12 @@ def _get_patient_meta(patient_metadata_path: str, slides_metadata: pd.DataFrame,
 
 def _generate_patient_meta(slides_metadata: pd.DataFrame, tiles_folder: str) -> pd.DataFrame:
     patient_meta = defaultdict(lambda: [0, 0, None]) # store nr_tiles_total, nr_tiles_cancer and cancer subtype per patient
+    manifest = _open_manifest(tiles_folder)
 
     for _, row in slides_metadata.iterrows():
         slide_id, patient_id = row['slide_id'], row['patient_id']
         patient_cancer_type, tissue_type = row['cancer_subtype'], row['tissue_type']
-        nr_tiles = _get_number_of_tiles(slide_id, tiles_folder)
+        nr_tiles = _get_number_of_tiles(slide_id, tiles_folder, manifest)
         
         if patient_id not in patient_meta:
             patient_meta[patient_id][2] = patient_cancer_type
@@ -76,7 +79,21 @@ def _generate_patient_meta(slides_metadata: pd.DataFrame, tiles_folder: str) ->
     return _convert_to_dataframe(patient_meta)
 
 
-def _get_number_of_tiles(slide_id: str, tiles_folder: str) -> int:
+def _open_manifest(tiles_folder: str) -> Optional[TilingManifest]:
+    # None for tiles generated without a manifest
+    manifest_path = os.path.join(tiles_folder, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+    return TilingManifest(manifest_path)
+
+
+def _get_number_of_tiles(slide_id: str, tiles_folder: str, manifest: Optional[TilingManifest] = None) -> int:
+    if manifest is not None: # tile counts are recorded in the manifest, slides that are not completely tiled count as empty
+        nr_tiles = manifest.get_num_tiles(slide_id)
+        return 0 if nr_tiles is None else nr_tiles
+    shard_path = shard_paths.get_shard_path(tiles_folder, slide_id)
+    if os.path.exists(shard_path): # count tiles in the shard index instead of listing files
+        return shard_paths.get_number_of_tiles(shard_path)
     tiles_folder_of_slide = os.path.join(tiles_folder, slide_id)
     try: 
         nr_tiles = len([x for x in os.listdir(tiles_folder_of_slide) if x.endswith('.jpeg')])
@@ -138,14 +155,21 @@ def _write_csv_files(tiles_folder: str, output_folder: str, patient_to_category:
         for csv in output_csv.values(): 
             csv.write('path,reference_value\n')
 
-        # Fill csv files
-        slide_folders = glob(os.path.join(tiles_folder, '*'))
+        # Fill csv files, skipping slides whose tiling was interrupted or failed
+        manifest = _open_manifest(tiles_folder)
+        tiled_slide_ids = None if manifest is None else manifest.get_tiled_slide_ids()
+        slide_folders = [f for f in glob(os.path.join(tiles_folder, '*')) if os.path.isdir(f)]
         for slide_folder in slide_folders:
-            _write_info(slide_folder, output_csv, output_folder, patient_to_category, slides_metadata, classes)
+            if tiled_slide_ids is None or os.path.basename(slide_folder) in tiled_slide_ids:
+                _write_info(slide_folder, output_csv, output_folder, patient_to_category, slides_metadata, classes)
+        # Slides stored as shards are referenced by one line per shard instead of one line per tile
+        for shard_path in glob(os.path.join(tiles_folder, '*' + shard_paths.SHARD_EXTENSION)):
+            if tiled_slide_ids is None or shard_paths.get_slide_id_from_shard_path(shard_path) in tiled_slide_ids:
+                _write_info(shard_path, output_csv, output_folder, patient_to_category, slides_metadata, classes)
         
 
 def _write_info(slide_folder: str, output_csv: dict, output_folder: str, patient_to_category: Dict[str, str], slides_metadata: pd.DataFrame, classes: Dict[str, int]) -> None:
-    slide_id = slide_folder.split('/')[-1]
+    slide_id = shard_paths.get_slide_id_from_shard_path(slide_folder) if shard_paths.is_shard(slide_folder) else slide_folder.split('/')[-1]
     patient_id = slides_metadata[slides_metadata['slide_id'] == slide_id]['patient_id'].item()
     if patient_id in patient_to_category: 
         category = patient_to_category[patient_id]
@@ -154,8 +178,11 @@ def _write_info(slide_folder: str, output_csv: dict, output_folder: str, patient
             slide_class = str(classes[slide_tissue_type]) 
         except: # this skips 'normal' slides in the second sorting option that only considers luad vs. lusc slides
             return 
-        tiles = os.listdir(slide_folder)
-        tiles = [os.path.join(slide_folder, t) for t in tiles] # get full paths 
+        if shard_paths.is_shard(slide_folder):
+            tiles = [slide_folder]
+        else:
+            tiles = os.listdir(slide_folder)
+            tiles = [os.path.join(slide_folder, t) for t in tiles] # get full paths 
         tiles = [os.path.relpath(t, start=output_folder) for t in tiles] # convert to paths relative to output directory
         for tile in tiles:    
             output_csv[category].write(','.join([tile, slide_class]))
@@ -0,0 +1,54 @@
+import sqlite3
+from contextlib import closing, contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional, Set
+
+# Durable record of the tiling state per slide. A slide only counts as tiled if its tiling finished
+# with the same parameters, so interrupted runs and parameter changes lead to re-tiling of the affected slides only.
+
+MANIFEST_FILENAME = 'tiling_manifest.sqlite'
+TILING_PARAMETERS = ['pixel_spacing', 'tile_size', 'every_xth_tile', 'output_format']
+
+
+class TilingManifest:
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS slides ('
+                'slide_id TEXT PRIMARY KEY, status TEXT NOT NULL, pixel_spacing REAL, tile_size INTEGER, '
+                'every_xth_tile INTEGER, output_format TEXT, num_tiles INTEGER, updated TEXT)')
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # One connection per operation, such that the manifest can be used from several threads. The operation
+        # runs as one transaction and the connection is closed afterwards.
+        with closing(sqlite3.connect(self.path, timeout=60)) as connection:
+            with connection:
+                yield connection
+
+    def is_tiled(self, slide_id: str, parameters: Dict[str, Any]) -> bool:
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT status, ' + ', '.join(TILING_PARAMETERS) + ' FROM slides WHERE slide_id = ?', (slide_id,)).fetchone()
+        if row is None or row[0] != 'tiled':
+            return False
+        return all(value == parameters[name] for name, value in zip(TILING_PARAMETERS, row[1:]))
+
+    def get_num_tiles(self, slide_id: str) -> Optional[int]:
+        with self._connect() as connection:
+            row = connection.execute("SELECT num_tiles FROM slides WHERE slide_id = ? AND status = 'tiled'", (slide_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_tiled_slide_ids(self) -> Set[str]:
+        with self._connect() as connection:
+            rows = connection.execute("SELECT slide_id FROM slides WHERE status = 'tiled'").fetchall()
+        return set(row[0] for row in rows)
+
+    def set_status(self, slide_id: str, status: str, parameters: Dict[str, Any], num_tiles: int = None) -> None:
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO slides (slide_id, status, ' + ', '.join(TILING_PARAMETERS) + ', num_tiles, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (slide_id, status) + tuple(parameters[name] for name in TILING_PARAMETERS) + (num_tiles, datetime.now().isoformat()))
@@ -4,9 +4,12 @@ import subprocess
 from wsidicom import WsiDicom
 from pydicom import config 
 config.enforce_valid_values = False
-from typing import List
+from typing import Dict, List
 
-from .tile_generation import _get_path_to_slide_from_gcs_url
+from .tile_generation import _get_path_to_slide_from_gcs_url, open_slide
+
+# Same IDC version as the slides metadata, see lung_cancer_cptac_DataExploration.ipynb
+IDC_DICOM_TABLE = 'bigquery-public-data.idc_v11.dicom_all'
 
 
 def get_required_or_next_higher_resolution_slides(slides_df: pd.DataFrame, pixel_spacing_low: float, pixel_spacing_up: float) -> pd.DataFrame: 
@@ -49,11 +52,42 @@ def get_random_testset_slide_ids(slides_metadata: pd.DataFrame) -> List[str]:
     return slide_ids
 
 
-def get_thumbnails(slide_ids: List[str], metadata_path: str, output_folder: str, google_cloud_project_id: str) -> None:
+def get_thumbnails(slide_ids: List[str], metadata_path: str, output_folder: str, google_cloud_project_id: str, range_reads: bool = False) -> None:
     slides_metadata = pd.read_csv(metadata_path)
-    for slide_id in slide_ids: 
+    if range_reads:
+        gcs_urls = [slides_metadata[slides_metadata['slide_id']==slide_id]['gcs_url'].iloc[0] for slide_id in slide_ids]
+        lowest_resolution_gcs_urls = _get_lowest_resolution_gcs_urls(gcs_urls, google_cloud_project_id)
+    for i, slide_id in enumerate(slide_ids): 
         print('Generate thumbnail for slide %s' %(slide_id))
-        _get_thumbnail(slide_id, slides_metadata, output_folder, google_cloud_project_id)
+        if range_reads:
+            _get_thumbnail_by_range_reads(slide_id, lowest_resolution_gcs_urls.get(gcs_urls[i], gcs_urls[i]), output_folder, google_cloud_project_id)
+        else:
+            _get_thumbnail(slide_id, slides_metadata, output_folder, google_cloud_project_id)
+
+
+def _get_lowest_resolution_gcs_urls(gcs_urls: List[str], google_cloud_project_id: str) -> Dict[str, str]:
+    # The slides metadata usually holds a single instance per slide, e.g. after get_required_or_next_higher_resolution_slides.
+    # Maps the GCS URL of any volume instance to the one of the lowest resolution instance of the same series.
+    from google.cloud import bigquery
+    client = bigquery.Client(project=google_cloud_project_id)
+    query = '''
+        SELECT 
+          requested.gcs_url AS requested_gcs_url,
+          ARRAY_AGG(instances.gcs_url ORDER BY instances.TotalPixelMatrixColumns LIMIT 1)[OFFSET(0)] AS gcs_url
+        FROM `{table}` AS requested
+        JOIN `{table}` AS instances ON instances.SeriesInstanceUID = requested.SeriesInstanceUID
+        WHERE requested.gcs_url IN UNNEST(@gcs_urls) AND instances.ImageType[SAFE_OFFSET(2)] = 'VOLUME'
+        GROUP BY requested.gcs_url'''.format(table=IDC_DICOM_TABLE)
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ArrayQueryParameter('gcs_urls', 'STRING', gcs_urls)])
+    result = client.query(query, job_config=job_config).to_dataframe()
+    return dict(zip(result['requested_gcs_url'], result['gcs_url']))
+
+
+def _get_thumbnail_by_range_reads(slide_id: str, gcs_url: str, output_folder: str, google_cloud_project_id: str) -> None:  
+    # Read the given instance, i.e. the smallest level of the slide, directly from the bucket instead of downloading the file
+    slide = open_slide(gcs_url, google_cloud_project_id)
+    thumbnail = slide.read_thumbnail((300,300)) # get and save thumbnail image
+    thumbnail.save(os.path.join(output_folder, slide_id + '.png'))
 
 
 def _get_thumbnail(slide_id: str, slides_metadata: pd.DataFrame, output_folder: str, google_cloud_project_id: str) -> None:  
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+from typing import Callable, Tuple
+
+# Aggregations of tile predictions to one prediction per slide. The tile predictions (num_tiles x num_classes)
+# are sorted by slide, slide i covering rows starts[i]:starts[i] + counts[i], and every aggregation
+# returns one row per slide. Aggregations with parameters are created by factory functions, e.g. top_k_mean(10).
+
+Aggregation = Callable[[np.ndarray, np.ndarray, np.ndarray], np.ndarray]
+
+
+def get_slide_groups(slide_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Returns the sorted unique slide IDs, the order of the tiles sorted by slide, and start and number of tiles per slide
+    codes, unique_slide_ids = pd.factorize(slide_ids, sort=True)
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=len(unique_slide_ids))
+    starts = np.cumsum(counts) - counts
+    return np.asarray(unique_slide_ids), order, starts, counts
+
+
+def mean_probability(predictions: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    return np.add.reduceat(predictions, starts, axis=0) / counts[:, np.newaxis]
+
+
+def max_probability(predictions: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    return np.maximum.reduceat(predictions, starts, axis=0)
+
+
+def fraction_positive(threshold: float = 0.5) -> Aggregation:
+    # Fraction of tiles with a probability of at least threshold
+    def aggregate(predictions: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        return mean_probability((predictions >= threshold).astype(np.float64), starts, counts)
+    return aggregate
+
+
+def top_k_mean(k: int) -> Aggregation:
+    # Mean of the k highest probabilities, or of all probabilities for slides with fewer tiles
+    def aggregate(predictions: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        sorted_predictions = _sort_within_slides(predictions, counts)
+        cumulative = np.concatenate([np.zeros((1, predictions.shape[1])), np.cumsum(sorted_predictions, axis=0)])
+        ends = starts + counts
+        num_top = np.minimum(k, counts)
+        return (cumulative[ends] - cumulative[ends - num_top]) / num_top[:, np.newaxis]
+    return aggregate
+
+
+def quantile(q: float) -> Aggregation:
+    # Linearly interpolated quantile, as np.quantile
+    def aggregate(predictions: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        sorted_predictions = _sort_within_slides(predictions, counts)
+        positions = starts + q * (counts - 1)
+        lower = np.floor(positions).astype(np.int64)
+        upper = np.minimum(lower + 1, starts + counts - 1)
+        weights = (positions - lower)[:, np.newaxis]
+        return (1 - weights) * sorted_predictions[lower] + weights * sorted_predictions[upper]
+    return aggregate
+
+
+def _sort_within_slides(predictions: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    # Sorts the probabilities of every class within each slide, keeping the slides in place
+    slide_indices = np.repeat(np.arange(len(counts)), counts)
+    sorted_predictions = np.empty(predictions.shape, dtype=np.float64)
+    for c in range(predictions.shape[1]):
+        order = np.lexsort((predictions[:, c], slide_indices))
+        sorted_predictions[:, c] = predictions[order, c]
+    return sorted_predictions
@@ -0,0 +1,97 @@
+import numpy as np
+from scipy import stats
+from typing import Tuple
+
+# Rank-based (Mann-Whitney) AUC computations. For binary reference values, the AUC equals
+# sklearn.metrics.roc_auc_score, including the handling of tied predictions.
+
+
+def get_positive_mask(reference: np.ndarray) -> np.ndarray:
+    # As in sklearn, the greater of the two labels is the positive one
+    reference = np.asarray(reference)
+    return reference == np.max(reference)
+
+
+def get_bootstrapped_aucs(reference: np.ndarray, prediction: np.ndarray, num_bootstraps: int = 1000, seed: int = 0,
+                          max_chunk_elements: int = 2**22) -> np.ndarray:
+    positive = get_positive_mask(reference)
+    prediction = np.asarray(prediction).ravel()
+    num_samples = len(prediction)
+
+    # Each bootstrap sample is a multiset of the original samples, so its AUC only depends on how often every
+    # distinct prediction value is drawn for positive and for negative samples. Counting them replaces sorting.
+    _, value_indices = np.unique(prediction, return_inverse=True)
+    num_values = int(value_indices.max()) + 1
+    bins = 2 * value_indices.ravel() + positive  # even: negative, odd: positive
+
+    # The index matrix of the bootstrap samples is processed in chunks of rows to bound memory usage
+    rng = np.random.default_rng(seed)
+    chunk_size = max(1, min(num_bootstraps, max_chunk_elements // num_samples))
+    aucs = []
+    for start in range(0, num_bootstraps, chunk_size):
+        curr_chunk_size = min(chunk_size, num_bootstraps - start)
+        bootstrap_indices = rng.integers(0, num_samples, size=(curr_chunk_size, num_samples))
+        offsets = np.arange(curr_chunk_size)[:, np.newaxis] * 2 * num_values
+        counts = np.bincount((bins[bootstrap_indices] + offsets).ravel(), minlength=curr_chunk_size * 2 * num_values)
+        counts = counts.reshape(curr_chunk_size, num_values, 2)
+        aucs.append(get_aucs_from_counts(counts[:, :, 1], counts[:, :, 0]))
+    aucs = np.concatenate(aucs)
+
+    # We need at least one positive and one negative sample
+    return aucs[~np.isnan(aucs)]
+
+
+def get_aucs_from_counts(positive_counts: np.ndarray, negative_counts: np.ndarray) -> np.ndarray:
+    # Rows are samples, columns the number of positives and negatives per prediction value in ascending order.
+    # A positive wins against every negative with a smaller prediction and half wins against ties.
+    num_positives = positive_counts.sum(axis=1)
+    num_negatives = negative_counts.sum(axis=1)
+    negatives_below = np.cumsum(negative_counts, axis=1) - negative_counts
+    wins = (positive_counts * (negatives_below + 0.5 * negative_counts)).sum(axis=1)
+    aucs = np.full(len(wins), np.nan)
+    valid = (num_positives > 0) & (num_negatives > 0)
+    aucs[valid] = wins[valid] / (num_positives[valid].astype(np.float64) * num_negatives[valid])
+    return aucs
+
+
+def get_percentile_interval(scores: np.ndarray, alpha: float = 0.05) -> Tuple[float, float]:
+    scores = np.sort(scores)
+    return scores[int(alpha / 2 * len(scores))], scores[int((1 - alpha / 2) * len(scores))]
+
+
+def get_delong_aucs_and_covariance(reference: np.ndarray, predictions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Fast DeLong algorithm (Sun and Xu, 2014): AUCs of several predictions of the same samples, given as rows,
+    # and their covariance matrix in O(n log n) per prediction
+    positive = get_positive_mask(reference)
+    predictions = np.atleast_2d(np.asarray(predictions, dtype=np.float64))
+    positive_predictions = predictions[:, positive]
+    negative_predictions = predictions[:, ~positive]
+    num_positives = positive_predictions.shape[1]
+    num_negatives = negative_predictions.shape[1]
+
+    # Midranks within the positives, within the negatives and within all samples
+    positive_ranks = stats.rankdata(positive_predictions, axis=1)
+    negative_ranks = stats.rankdata(negative_predictions, axis=1)
+    all_ranks = stats.rankdata(np.concatenate([positive_predictions, negative_predictions], axis=1), axis=1)
+
+    aucs = (all_ranks[:, :num_positives].sum(axis=1) - num_positives * (num_positives + 1) / 2) / (num_positives * num_negatives)
+    positive_components = (all_ranks[:, :num_positives] - positive_ranks) / num_negatives
+    negative_components = 1.0 - (all_ranks[:, num_positives:] - negative_ranks) / num_positives
+    covariance = np.atleast_2d(np.cov(positive_components)) / num_positives + np.atleast_2d(np.cov(negative_components)) / num_negatives
+    return aucs, covariance
+
+
+def get_delong_interval(reference: np.ndarray, prediction: np.ndarray, alpha: float = 0.05) -> Tuple[float, float]:
+    aucs, covariance = get_delong_aucs_and_covariance(reference, np.ravel(prediction))
+    half_width = stats.norm.ppf(1 - alpha / 2) * np.sqrt(covariance[0, 0])
+    return max(0.0, aucs[0] - half_width), min(1.0, aucs[0] + half_width)
+
+
+def compare_aucs_by_delong(reference: np.ndarray, prediction: np.ndarray, other_prediction: np.ndarray) -> Tuple[float, float]:
+    # Paired two-sided test of the AUCs of two predictions of the same samples, returns z-score and p-value
+    aucs, covariance = get_delong_aucs_and_covariance(reference, np.stack([np.ravel(prediction), np.ravel(other_prediction)]))
+    variance = covariance[0, 0] + covariance[1, 1] - 2 * covariance[0, 1]
+    if variance <= 0:
+        return 0.0, 1.0
+    z = (aucs[0] - aucs[1]) / np.sqrt(variance)
+    return z, 2 * stats.norm.sf(abs(z))
@@ -1,7 +1,6 @@
 import numpy as np 
 import pandas as pd
 import tensorflow as tf
-from typing import Dict
 from datetime import datetime
 
 from ..data.data_set import Dataset
@@ -9,7 +8,7 @@ from ..data.data_set import Dataset
 
 class Predictions():
     
-    def __init__(self, model: tf.keras.Model = None, dataset: Dataset = None, batch_size: int = 2, predictions: pd.DataFrame = None) -> None:
+    def __init__(self, model: tf.keras.Model = None, dataset: Dataset = None, batch_size: int = 256, predictions: pd.DataFrame = None) -> None:
         
         if predictions is not None: 
             self.predictions = predictions
@@ -21,31 +20,62 @@ class Predictions():
         predictions = pd.read_csv(file_path)
         return cls(predictions = predictions)
 
-    def _make_predictions(self, model: tf.keras.Model, dataset: Dataset, batch_size: int = 2) -> pd.DataFrame:
-        batch_predictions = np.empty((0,3), np.float32)
-        for i in range(0, len(dataset.data_points), batch_size): 
-            batch = dataset.data_points[i:i+batch_size]
-            batch_prediction = model.make_prediction(batch).numpy()
-            batch_predictions = np.append(batch_predictions, batch_prediction, axis = 0)
-        predictions = self._predictions_to_df(dataset, batch_predictions)
-        print()
-        return predictions
+    @classmethod
+    def load_parquet(cls, file_path: str) -> 'Predictions':
+        # Loads predictions stored with save_parquet. The file is memory-mapped and the probabilities of 
+        # all tiles end up in one contiguous float32 array, of which the prediction column holds row views.
+        predictions = pd.read_parquet(file_path, memory_map=True)
+        probability_columns = [c for c in predictions.columns if c.startswith('prediction_')]
+        probability_columns.sort(key=lambda c: int(c[len('prediction_'):]))
+        probabilities = np.ascontiguousarray(predictions[probability_columns].to_numpy(dtype=np.float32))
+        tile_positions = np.stack([predictions['tile_col'].to_numpy(), predictions['tile_row'].to_numpy()], axis=1)
+        reference_values = predictions['reference_value']
+        if reference_values.dtype == object: # multi-label reference values are stored as lists
+            reference_values = reference_values.map(list)
+        return cls(predictions = cls._to_df(predictions['slide_id'].to_numpy(), tile_positions, reference_values.to_numpy(), probabilities))
 
-    def _predictions_to_df(self, dataset: Dataset, batch_predictions: np.ndarray) -> Dict: 
-        predictions_dict = {}
-        for i, data_point in enumerate(dataset.data_points):
-            slide_id = data_point.get_slide_id()
-            predictions_dict[i] = {
-                'slide_id': slide_id,
-                'tile_position': data_point.get_position(),
-                'reference_value': data_point.get_reference_value(),
-                'prediction': batch_predictions[i]
-        }
-        predictions = pd.DataFrame.from_dict(predictions_dict, orient='index')
-        test = pd.DataFrame(predictions['prediction'].to_list())
-        predictions = pd.concat([predictions, test], axis=1)
-        return predictions
+    def _make_predictions(self, model: tf.keras.Model, dataset: Dataset, batch_size: int = 256) -> pd.DataFrame:
+        # Batches of decoded patches are streamed from the tf.data pipeline and their predictions are written 
+        # into a preallocated array at the indices of the tiles, see Dataset.get_prediction_tf_dataset. The array is 
+        # allocated from the number of tiles and the output width of the model, such that an empty dataset yields no rows.
+        slide_ids, tile_positions, reference_values = dataset.get_tile_info()
+        probabilities = np.empty((len(slide_ids), model.model.output_shape[-1]), np.float32)
+        for batch, indices in dataset.get_prediction_tf_dataset(batch_size):
+            probabilities[indices.numpy()] = model.predict_batch(batch)
+        return self._to_df(slide_ids, tile_positions, reference_values, probabilities)
 
+    @staticmethod
+    def _to_df(slide_ids: np.ndarray, tile_positions: np.ndarray, reference_values: np.ndarray, probabilities: np.ndarray) -> pd.DataFrame:
+        # One row per tile, the probabilities of a tile as array in the prediction column and additionally as one column per class
+        predictions = pd.DataFrame({
+            'slide_id': slide_ids,
+            'tile_position': list(tile_positions),
+            'reference_value': reference_values,
+            'prediction': list(probabilities)
+        })
+        return pd.concat([predictions, pd.DataFrame(probabilities)], axis=1)
+
+    def save_parquet(self, path: str) -> None:
+        # Columnar binary format: int32 tile_col and tile_row, one float32 column prediction_[CLASS] per class 
+        # and reference values as int32, or lists of int32 for multi-label data. Written without compression, 
+        # such that load_parquet can memory-map the file.
+        tile_positions = np.asarray(self.predictions['tile_position'].tolist(), dtype=np.int32).reshape(-1, 2)
+        probabilities = np.asarray(np.stack(self.predictions['prediction'].values), dtype=np.float32)
+        probabilities = probabilities.reshape(len(probabilities), -1)
+        reference_values = self.predictions['reference_value']
+        if reference_values.dtype == object:
+            reference_values = reference_values.map(lambda r: np.asarray(r, dtype=np.int32))
+        else:
+            reference_values = reference_values.astype(np.int32)
+        columns = {
+            'slide_id': self.predictions['slide_id'].astype(str).to_numpy(),
+            'tile_col': tile_positions[:, 0],
+            'tile_row': tile_positions[:, 1],
+            'reference_value': reference_values.to_numpy()
+        }
+        for i in range(probabilities.shape[1]):
+            columns['prediction_%d' % i] = probabilities[:, i]
+        pd.DataFrame(columns).to_parquet(path, index=False, compression=None)
 
     def save(self, path: str) -> None:
         self.predictions.to_csv(path)
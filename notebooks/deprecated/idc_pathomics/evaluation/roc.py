@@ -8,11 +8,12 @@ from collections import defaultdict
 import sklearn.metrics as skm
 from sklearn.preprocessing import label_binarize
 from sklearn.preprocessing import MultiLabelBinarizer
-from scipy import interp
 from copy import copy
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Callable
 
 from .predictions import Predictions 
+from .auc import get_bootstrapped_aucs, get_percentile_interval, get_delong_interval, compare_aucs_by_delong
+from .aggregation import get_slide_groups, mean_probability, fraction_positive
 
 
 EXPERIMENTS = {'norm_cancer': {0: 'Normal', 1:'Tumor'}, 'luad_lssc': {0:'LUAD', 1:'LSSC'}, 'norm_luad_lssc': {0:'Normal', 1:'LUAD', 2:'LSSC'}, 
@@ -22,16 +23,26 @@ EXPERIMENTS = {'norm_cancer': {0: 'Normal', 1:'Tumor'}, 'luad_lssc': {0:'LUAD',
 
 class ROCAnalysis():
 
-    def __init__(self, experiment: str = 'norm_luad_lssc') -> None:
+    def __init__(self, experiment: str = 'norm_luad_lssc', ci_method: str = 'bootstrap', num_bootstraps: int = 1000, seed: int = 0, 
+                 threshold: float = 0.5, aggregations: Dict[str, Callable] = None) -> None:
+        assert ci_method in ['bootstrap', 'delong']
         self.experiment = experiment
         self.num_classes = len(EXPERIMENTS[self.experiment])
+        # Slide-based analysis is run for every aggregation of tile predictions, see aggregation.py. 
+        # Additional aggregations, e.g. {'top_10_mean': top_k_mean(10)}, are added to the two default ones.
+        self.aggregations = {'average_probability': mean_probability, 'percentage_positive': fraction_positive(threshold)}
+        if aggregations is not None:
+            self.aggregations.update(aggregations)
+        self.ci_method = ci_method
+        self.num_bootstraps = num_bootstraps
+        self.seed = seed
 
     def run(self, predictions: Predictions) -> None: 
         # Tile-based analysis
         self.tile_auc, self.tile_ci = self._run_tile_based_roc_analysis(predictions)
         # Slide-based analysis
-        slide_data = self._prepare_data_for_slide_based_roc_analysis(predictions)
-        self.fpr, self.tpr, self.auc, self.ci = self._run_slide_based_roc_analysis(slide_data)
+        self.slide_data = self._prepare_data_for_slide_based_roc_analysis(predictions)
+        self.fpr, self.tpr, self.auc, self.ci = self._run_slide_based_roc_analysis(self.slide_data)
 
     def _run_tile_based_roc_analysis(self, predictions: Predictions) -> Tuple[dict,dict]:
         auc = {}
@@ -43,7 +54,7 @@ class ROCAnalysis():
         if self.num_classes == 2: 
             prediction = np.reshape(prediction, (1, -1)).squeeze()
             auc[1] = skm.roc_auc_score(reference, prediction)
-            ci[1] = self._get_confidence_interval_by_bootstrapping(reference, prediction)
+            ci[1] = self._get_confidence_interval(reference, prediction)
 
         # Multi-class and multi-class multi-label data: Calculate AUC for each class separately      
         else: 
@@ -51,59 +62,74 @@ class ROCAnalysis():
             auc_values = skm.roc_auc_score(reference, prediction, average=None)
             for i in range(self.num_classes):
                 auc[i] = auc_values[i]
-                ci[i] = self._get_confidence_interval_by_bootstrapping(reference[:, i], prediction[:,i])
+                ci[i] = self._get_confidence_interval(reference[:, i], prediction[:,i])
 
             if self.num_classes == 3: 
                 auc['micro'] = skm.roc_auc_score(reference.ravel(), prediction.ravel())
-                ci['micro'] = self._get_confidence_interval_by_bootstrapping(reference.ravel(), prediction.ravel())
+                ci['micro'] = self._get_confidence_interval(reference.ravel(), prediction.ravel())
                 auc['macro'] = sum(auc[i]for i in range(self.num_classes))/self.num_classes
 
         return auc, ci
 
 
-    def _get_confidence_interval_by_bootstrapping(self, reference: np.ndarray, prediction: np.ndarray, num_bootstraps: int = 1000) -> List[float]: 
-        bootstrap_scores = []
-
-        for i in range(num_bootstraps):
-            bootstrap_indices = np.random.randint(0, len(reference), size=len(reference))
-            reference_sample = reference[bootstrap_indices]
-            prediction_sample = prediction[bootstrap_indices]
-            # We need at least one positive and one negative sample
-            if len(np.unique(reference_sample)) < 2:
-                continue
-            else: 
-                auc = skm.roc_auc_score(reference_sample, prediction_sample)
-                bootstrap_scores.append(auc)
-
-        bootstrap_scores = np.asarray(bootstrap_scores)
-        bootstrap_scores.sort()
-        ci_lower = bootstrap_scores[int(0.025* len(bootstrap_scores))]
-        ci_upper = bootstrap_scores[int(0.975* len(bootstrap_scores))]
+    def _get_confidence_interval(self, reference: np.ndarray, prediction: np.ndarray) -> List[float]: 
+        if self.ci_method == 'delong':
+            return self._get_confidence_interval_by_delong(reference, prediction)
+        return self._get_confidence_interval_by_bootstrapping(reference, prediction)
+
+
+    def _get_confidence_interval_by_delong(self, reference: np.ndarray, prediction: np.ndarray) -> List[float]: 
+        # Analytic interval based on the DeLong variance of the AUC, no resampling required
+        ci_lower, ci_upper = get_delong_interval(reference, prediction)
+        return [ci_lower, ci_upper]
+
+
+    def _get_confidence_interval_by_bootstrapping(self, reference: np.ndarray, prediction: np.ndarray) -> List[float]: 
+        # All bootstrap samples are evaluated at once, using the same seed for every call to obtain reproducible intervals
+        bootstrap_scores = get_bootstrapped_aucs(reference, prediction, self.num_bootstraps, self.seed)
+        ci_lower, ci_upper = get_percentile_interval(bootstrap_scores)
         return [ci_lower, ci_upper]  
 
 
+    def compare_slide_aggregations(self) -> dict:
+        # Paired DeLong test of average_probability vs. percentage_positive per class, returns (z-score, p-value) per class.
+        # Requires run() to be called first.
+        average_probability = np.stack(self.slide_data['average_probability'].values)
+        percentage_positive = np.stack(self.slide_data['percentage_positive'].values)
+        return self._compare_per_class(self.slide_data['reference_value'].tolist(), average_probability, percentage_positive)
+
+
+    def compare_models(self, predictions: Predictions, other_predictions: Predictions) -> dict:
+        # Paired DeLong test of the tile-based AUCs of two models evaluated on the same tiles, returns (z-score, p-value) per class
+        reference = predictions.predictions['reference_value'].to_numpy()
+        assert np.array_equal(reference, other_predictions.predictions['reference_value'].to_numpy())
+        prediction = np.stack(predictions.predictions['prediction'].values)
+        other_prediction = np.stack(other_predictions.predictions['prediction'].values)
+        return self._compare_per_class(reference, prediction, other_prediction)
+
+
+    def _compare_per_class(self, reference: np.ndarray, prediction: np.ndarray, other_prediction: np.ndarray) -> dict:
+        if self.num_classes == 2:
+            return {1: compare_aucs_by_delong(np.asarray(reference), prediction.ravel(), other_prediction.ravel())}
+        reference = self._binarize_labels(reference)
+        return {i: compare_aucs_by_delong(reference[:, i], prediction[:, i], other_prediction[:, i]) for i in range(self.num_classes)}
+
+
     def _prepare_data_for_slide_based_roc_analysis(self, predictions: Predictions) -> pd.DataFrame:
-        results_per_slide = defaultdict(dict)
-
-        # Average predictions of tiles to obtain one prediction per slide
-        all_slide_ids = list(set(predictions.predictions['slide_id'].tolist()))
-        for slide_id in all_slide_ids:
-            slide_predictions = predictions.get_predictions_for_slide(slide_id)
-            reference_value = predictions.get_reference_value_for_slide(slide_id)
-            
-            average_probability = np.average(slide_predictions, axis=0)
-            positive = np.where(np.asarray(slide_predictions) >= 0.5, 1, 0)
-            percentage_positive = np.average(positive, axis=0)
-
-            results_per_slide[slide_id]['reference_value'] = reference_value
-            results_per_slide[slide_id]['average_probability'] = average_probability
-            results_per_slide[slide_id]['percentage_positive'] = percentage_positive
-        
-        # Turn results into pandas data frame: slide_id (str) | reference_value (int) | average_probability (list[int]) | percentage_positive (list[int]))
+        # Group the tiles by slide once and aggregate the predictions of all slides at once
+        slide_ids, order, starts, counts = get_slide_groups(predictions.predictions['slide_id'].to_numpy())
+        tile_predictions = np.stack(predictions.predictions['prediction'].values)[order]
+        tile_predictions = np.reshape(tile_predictions, (len(tile_predictions), -1))
+
+        reference_values = predictions.predictions['reference_value'].to_numpy()[order]
+        if reference_values.dtype != object: # multi-label reference values are lists
+            assert np.all(reference_values == np.repeat(reference_values[starts], counts))
+
+        # Turn results into pandas data frame: slide_id (str) | reference_value (int) | average_probability (list[int]) | percentage_positive (list[int]) | ...
         # Note: In two-class problem, average_probability and percentage_positive contain only one value, otherwise correspondingly to the number of classes.
-        result_df = pd.DataFrame(results_per_slide).T
-        result_df.reset_index(inplace=True)
-        result_df.rename({'index':'slide_id'}, axis='columns', inplace=True)
+        result_df = pd.DataFrame({'slide_id': slide_ids, 'reference_value': reference_values[starts]})
+        for column, aggregate in self.aggregations.items():
+            result_df[column] = list(aggregate(tile_predictions, starts, counts))
         return result_df
 
 
@@ -116,10 +142,10 @@ class ROCAnalysis():
         else: 
             fpr, tpr, auc, ci = {}, {}, {}, {} 
             reference = slide_data['reference_value'].tolist()
-            for column in ['average_probability', 'percentage_positive']:
+            for column in self.aggregations:
                 prediction = np.concatenate(slide_data[column]).ravel()
                 fpr[column], tpr[column], auc[column] = self._generate_roc_curve(reference, prediction)
-                ci[column] = self._get_confidence_interval_by_bootstrapping(np.asarray(reference), prediction)
+                ci[column] = self._get_confidence_interval(np.asarray(reference), prediction)
         
         return fpr, tpr, auc, ci
 
@@ -134,20 +160,20 @@ class ROCAnalysis():
         auc = defaultdict(dict)
         ci = defaultdict(dict)
         for i in range(self.num_classes):
-            for column in ['percentage_positive', 'average_probability']:
+            for column in self.aggregations:
                 prediction = np.asarray([x[i] for x in slide_data[column]])
                 fpr[column][i], tpr[column][i], auc[column][i] = self._generate_roc_curve(reference[:, i], prediction)
-                ci[column][i] = self._get_confidence_interval_by_bootstrapping(reference[:,i], prediction)
+                ci[column][i] = self._get_confidence_interval(reference[:,i], prediction)
 
         # Generate macro-average and micro-average ROC curve for the three-class classification problem
         if self.num_classes == 3:
-            for column in ['percentage_positive', 'average_probability']:
+            for column in self.aggregations:
                 fpr[column]['macro'], tpr[column]['macro'], auc[column]['macro'] = self._generate_macro_average_roc(tpr[column], fpr[column])
                 # TODO ci['macro] 
 
                 all_predictions = np.asarray([i for x in slide_data[column] for i in x])
                 fpr[column]['micro'], tpr[column]['micro'], auc[column]['micro'] = self._generate_roc_curve(reference.ravel(), all_predictions)
-                ci[column]['micro'] = self._get_confidence_interval_by_bootstrapping(reference.ravel(), all_predictions)
+                ci[column]['micro'] = self._get_confidence_interval(reference.ravel(), all_predictions)
 
         return fpr, tpr, auc, ci
 
@@ -177,7 +203,7 @@ class ROCAnalysis():
         # Interpolate true positive rate at the respective false positive rate
         mean_tpr = np.zeros_like(all_fpr)
         for i in range(3):
-            mean_tpr += interp(all_fpr, fpr[i], tpr[i])
+            mean_tpr += np.interp(all_fpr, fpr[i], tpr[i])
         mean_tpr = mean_tpr/self.num_classes  
 
         auc = skm.auc(all_fpr, mean_tpr)
@@ -207,7 +233,7 @@ class ROCAnalysis():
 
         # Plot ROC curves separately for the two averaging methods if num_classes > 2
         else: 
-            fig, axes = plt.subplots(1,2, figsize=(10,4))
+            fig, axes = plt.subplots(1, len(self.fpr), figsize=(5*len(self.fpr),4))
             fig.suptitle('Slide-based ROC analysis')
             for i, avg_method in enumerate(self.fpr):
                 self._plot_bisector(axes[i])
@@ -37,15 +37,20 @@ class BaseModel:
         output_path: str, 
         validation_dataset: Dataset = None, 
         class_weights: Dict[int, float] = None,
-        max_queue_size: int = 100) -> tf.keras.callbacks.History:
+        max_queue_size: int = 100,
+        use_tf_data: bool = True) -> tf.keras.callbacks.History:
 
-        training_generator = training_dataset.get_generator(
+        # tf.data pipelines decode the tiles in parallel, the generators load them one by one
+        get_batches = Dataset.get_tf_dataset if use_tf_data else Dataset.get_generator
+        training_generator = get_batches(
+            training_dataset,
             batch_size=batch_size,
             infinite=True,
             shuffle=True)
 
         if validation_dataset:
-            validation_generator = validation_dataset.get_generator(
+            validation_generator = get_batches(
+                validation_dataset,
                 batch_size=batch_size,
                 infinite=True)
             validation_steps = len(validation_dataset)//batch_size
@@ -86,16 +91,15 @@ class BaseModel:
     
     def make_prediction(self, data_points: List[DataPoint]) -> np.ndarray: 
         # Create batch
-        tile_size = self.model.layers[0].input_shape[0][1]
-        required_dtype = data_points[0].get_patch().dtype
-        batch = np.empty((0, tile_size, tile_size, 3), required_dtype)
-        for data_point in data_points:
-            patch = data_point.get_patch()[np.newaxis, ...] # add batch dimension
-            batch = np.append(batch, patch, axis=0)
+        batch = np.stack([data_point.get_patch() for data_point in data_points])
         # Make prediction 
         prediction = self.model(batch)
         return prediction
 
+    def predict_batch(self, batch: tf.Tensor) -> np.ndarray:
+        # Prediction for a batch of decoded patches, e.g. from Dataset.get_prediction_tf_dataset
+        return np.asarray(self.model(batch, training=False))
+
     def save(self, output_dir: str) -> None:
         self.model.save(
             os.path.join(output_dir, 'trained_model'),
@@ -0,0 +1,90 @@
+import io
+import os
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip('wsidicom')
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, VLWholeSlideMicroscopyImageStorage, generate_uid
+
+from idc_pathomics.data.range_file import LocalFileSource, RangeFile, open_range_slide
+
+
+def _write_slide(path: str, tile_size: int = 16, cols: int = 4, rows: int = 3) -> np.ndarray:
+    # Single-level, uncompressed WSI DICOM with TILED_FULL frames in row-major order
+    tiles = np.random.default_rng(0).integers(0, 256, size=(rows, cols, tile_size, tile_size, 3), dtype=np.uint8)
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = VLWholeSlideMicroscopyImageStorage
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = VLWholeSlideMicroscopyImageStorage
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.FrameOfReferenceUID = generate_uid()
+    ds.Modality = 'SM'
+    ds.ImageType = ['ORIGINAL', 'PRIMARY', 'VOLUME', 'NONE']
+    ds.DimensionOrganizationType = 'TILED_FULL'
+    ds.TotalPixelMatrixColumns = cols * tile_size
+    ds.TotalPixelMatrixRows = rows * tile_size
+    ds.TotalPixelMatrixFocalPlanes = 1
+    ds.NumberOfOpticalPaths = 1
+    ds.Columns = ds.Rows = tile_size
+    ds.NumberOfFrames = cols * rows
+    ds.SamplesPerPixel = 3
+    ds.PhotometricInterpretation = 'RGB'
+    ds.PlanarConfiguration = 0
+    ds.BitsAllocated = ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    ds.ImagedVolumeWidth = cols * tile_size * 0.001
+    ds.ImagedVolumeHeight = rows * tile_size * 0.001
+    ds.ImagedVolumeDepth = 0.001
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = [0.001, 0.001]
+    pixel_measures.SpacingBetweenSlices = pixel_measures.SliceThickness = 0.001
+    shared_functional_groups = Dataset()
+    shared_functional_groups.PixelMeasuresSequence = Sequence([pixel_measures])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared_functional_groups])
+    optical_path = Dataset()
+    optical_path.OpticalPathIdentifier = '0'
+    ds.OpticalPathSequence = Sequence([optical_path])
+    ds.PixelData = tiles.tobytes()
+    ds.save_as(path, enforce_file_format=True)
+    return tiles
+
+
+def test_range_file_reads_like_local_file(tmp_path):
+    path = str(tmp_path / 'data.bin')
+    data = np.random.default_rng(0).integers(0, 256, size=10000, dtype=np.uint8).tobytes()
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    range_file = io.BufferedReader(RangeFile(LocalFileSource(path), block_size=1000, max_cached_blocks=2), buffer_size=64)
+    range_file.seek(2990)
+    assert range_file.read(20) == data[2990:3010]
+    range_file.seek(-5, io.SEEK_END)
+    assert range_file.read() == data[-5:]
+
+
+def test_open_range_slide_reads_through_range_source(tmp_path, monkeypatch):
+    path = str(tmp_path / 'slide.dcm')
+    tiles = _write_slide(path)
+    read_ranges = []
+    read_range = LocalFileSource.read_range
+    monkeypatch.setattr(LocalFileSource, 'read_range', lambda self, start, length: read_ranges.append((start, length)) or read_range(self, start, length))
+
+    slide = open_range_slide(path)
+    try:
+        assert (slide.size.width, slide.size.height) == (64, 48)
+        np.testing.assert_array_equal(np.asarray(slide.read_tile(0, (2, 1))), tiles[1, 2])
+        assert slide.read_thumbnail((8, 8)).size == (8, 6)
+    finally:
+        slide.close()
+    assert len(read_ranges) > 0
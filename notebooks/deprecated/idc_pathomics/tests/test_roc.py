@@ -0,0 +1,43 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('sklearn')
+pytest.importorskip('seaborn')
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from idc_pathomics.evaluation.aggregation import top_k_mean
+from idc_pathomics.evaluation.predictions import Predictions
+from idc_pathomics.evaluation.roc import ROCAnalysis
+
+
+def _get_predictions(num_classes: int, num_slides: int = 12, tiles_per_slide: int = 20) -> Predictions:
+    rng = np.random.default_rng(0)
+    reference_values = np.arange(num_slides) % num_classes
+    slide_ids = np.repeat(['slide_%d' % i for i in range(num_slides)], tiles_per_slide)
+    probabilities = rng.dirichlet(np.ones(num_classes), size=num_slides * tiles_per_slide).astype(np.float32)
+    if num_classes == 2: # single sigmoid output
+        probabilities = probabilities[:, 1:]
+    tile_positions = np.stack([np.arange(len(slide_ids)), np.zeros(len(slide_ids))], axis=1).astype(np.int32)
+    return Predictions(predictions=Predictions._to_df(slide_ids, tile_positions, np.repeat(reference_values, tiles_per_slide), probabilities))
+
+
+def test_additional_aggregation_in_multiclass_analysis():
+    roc_analysis = ROCAnalysis('norm_luad_lssc', ci_method='delong', aggregations={'top_5_mean': top_k_mean(5)})
+    roc_analysis.run(_get_predictions(num_classes=3))
+
+    assert set(roc_analysis.auc) == {'average_probability', 'percentage_positive', 'top_5_mean'}
+    for column in roc_analysis.auc:
+        assert set(roc_analysis.auc[column]) == {0, 1, 2, 'macro', 'micro'}
+        assert set(roc_analysis.ci[column]) == {0, 1, 2, 'micro'}
+
+
+def test_additional_aggregation_in_two_class_analysis():
+    roc_analysis = ROCAnalysis('norm_cancer', ci_method='delong', aggregations={'top_5_mean': top_k_mean(5)})
+    roc_analysis.run(_get_predictions(num_classes=2))
+
+    assert set(roc_analysis.auc) == {'average_probability', 'percentage_positive', 'top_5_mean'}
+    assert 0.0 <= roc_analysis.auc['top_5_mean'] <= 1.0
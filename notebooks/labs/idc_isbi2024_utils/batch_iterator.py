@@ -1,14 +1,17 @@
 import random
 import numpy as np 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from wsidicom import WsiDicom
 from PIL import Image
-from tensorflow.keras.preprocessing.image import img_to_array
-from typing import Callable, List, Tuple
+from typing import Callable, List, Optional, Tuple
 
 
 class BatchIterator:
     """
     An iterator class to iterate sequentially over all WSI respectively their tiles during network inference.
+    The background threads (see num_workers) are shut down once the iteration is exhausted. Callers that stop 
+    iterating early must call close() or use the BatchIterator as a context manager.
 
     Attributes
     ----------
@@ -24,10 +27,27 @@ class BatchIterator:
         Batch size for network inference. Default: 1.
     _tile_positions: list
         List containing all tile positions present in a WSI. 
+    _read_native_tiles: bool
+        Whether the tile grid lines up with the frame grid stored in the DICOM file, such that
+        tiles can be read as whole frames instead of as arbitrary regions.
+    _num_workers: int
+        Number of threads reading and checking tiles in the background. 0 reads tiles on the calling thread.
+    _prefetch_batches: int
+        Number of batches worth of tiles that are read ahead of the batch currently being assembled.
+    _executor: ThreadPoolExecutor
+        Thread pool used for reading tiles, None if tiles are read on the calling thread.
+    _pending: deque
+        Tile positions and corresponding futures of tiles that are currently read in the background, in tile order.
+    _dtype: np.dtype
+        Data type of the batches. 
+    _batch_buffers: list
+        Pool of preallocated batch arrays that are reused in turn.
     """
     def __init__(self, wsi: WsiDicom, tile_size: int, level: int, 
                  accept_function: Callable[[Image.Image], bool], batch_size: int = 1,
-                 coverage: float = 1.0) -> None:
+                 coverage: float = 1.0, num_workers: int = 0, prefetch_batches: int = 2,
+                 min_tissue_fraction: Optional[float] = None, dtype: np.dtype = np.float32, 
+                 num_buffers: int = 2) -> None:
         """
         Constructor of BatchIterator.    
 
@@ -45,17 +65,42 @@ class BatchIterator:
             Batch size for network inference. Default: 1.
         coverage: float
             Percentage of tiles of a WSI that should be used for inference.   
+        num_workers: int
+            Number of threads reading and checking tiles while the previous batch is processed. 
+            Default: 0, i.e. tiles are read sequentially on the calling thread.
+        prefetch_batches: int
+            Number of batches worth of tiles to read ahead if num_workers > 0. Default: 2.
+        min_tissue_fraction: float
+            If given, tile positions whose tissue fraction as estimated on the thumbnail is below this value
+            are dropped before any tile is read. Should be chosen more permissive than the accept function. 
+            Default: None, i.e. all tile positions are read.
+        dtype: np.dtype
+            Data type of the batches. Tiles are scaled to [-1, 1] for floating point types, while for np.uint8 
+            the raw pixel values are returned and scaling is left to the model. Default: np.float32.
+        num_buffers: int
+            Number of batch arrays that are reused in turn. A returned batch is a view into one of them and 
+            is overwritten once num_buffers further batches have been prepared. Default: 2.
         """  
         self._wsi = wsi
         self._tile_size = tile_size
         self._level = level
         self._batch_size = batch_size
         self._tile_positions = self._compile_all_tile_positions(\
-            wsi, tile_size, level, coverage)
+            wsi, tile_size, level, coverage, min_tissue_fraction)
         self._accept_function = accept_function
+        self._read_native_tiles = self._is_aligned_with_frame_grid(wsi, tile_size, level)
+        self._num_workers = num_workers
+        self._prefetch_batches = max(1, prefetch_batches)
+        self._executor = None
+        self._pending = deque()
+        self._dtype = np.dtype(dtype)
+        self._batch_buffers = [np.empty((batch_size, tile_size, tile_size, 3), dtype=self._dtype) 
+                               for _ in range(max(1, num_buffers))]
+        self._buffer_index = 0
 
     @staticmethod
-    def _compile_all_tile_positions(wsi: WsiDicom, tile_size: int, level: int, coverage: float) -> list:
+    def _compile_all_tile_positions(wsi: WsiDicom, tile_size: int, level: int, coverage: float,
+                                    min_tissue_fraction: Optional[float] = None) -> list:
         """
         Compiles all possible tile positions with a certain tile size in a WSI with a certain pixel_spacing.
 
@@ -69,6 +114,9 @@ class BatchIterator:
             Level at which the tiles should be extracted 
         coverage: float
             Percentage of tiles of a WSI that should be used for inference. 
+        min_tissue_fraction: float
+            Minimum tissue fraction as estimated on the thumbnail for a tile position to be kept. 
+            Default: None, i.e. no tile positions are dropped.
 
         Returns
         -------
@@ -79,28 +127,194 @@ class BatchIterator:
         (cols, rows) = (image_size[0] // tile_size, image_size[1] // tile_size)
         tile_positions = [(tile_pos_x, tile_pos_y) for tile_pos_y in range(0, rows) for tile_pos_x in range(0, cols)]
         tile_positions = random.sample(tile_positions, int(len(tile_positions) * coverage))
+        if min_tissue_fraction is not None:
+            tissue_mask = BatchIterator._compute_tissue_mask(wsi, image_size, tile_size, min_tissue_fraction)
+            tile_positions = [tile_pos for tile_pos in tile_positions if tissue_mask[tile_pos[1], tile_pos[0]]]
         return tile_positions
+
+    @staticmethod
+    def _compute_tissue_mask(wsi: WsiDicom, image_size: Tuple[int, int], tile_size: int, 
+                             min_tissue_fraction: float, mask_pixels_per_tile: int = 4, 
+                             background_threshold: int = 220) -> np.ndarray:
+        """
+        Estimates which tile positions show tissue using the thumbnail of the WSI. 
+        The thumbnail is resampled to mask_pixels_per_tile x mask_pixels_per_tile pixels per tile position 
+        and pixels with a grey value >= background_threshold are considered as background.
+
+        Parameters
+        ---------- 
+        wsi: 'WsiDicom'
+            WsiDicom object to be considered for now.
+        image_size: tuple
+            Size (width, height) of the image at the level the tile grid refers to.
+        tile_size: int
+            Size of the tiles. 
+        min_tissue_fraction: float
+            Minimum tissue fraction for a tile position to be kept.
+        mask_pixels_per_tile: int
+            Resolution of the mask in pixels per tile position and axis. Default: 4.
+        background_threshold: int
+            Grey value from which on a pixel is considered as background. Default: 220.
+
+        Returns
+        -------
+        np.ndarray
+            Boolean array of shape (rows, cols) being True for tile positions to keep.   
+        """ 
+        (cols, rows) = (image_size[0] // tile_size, image_size[1] // tile_size)
+        mask_size = (round(image_size[0] / tile_size * mask_pixels_per_tile), 
+                     round(image_size[1] / tile_size * mask_pixels_per_tile))
+        thumbnail = wsi.read_thumbnail(size=mask_size).convert(mode='L').resize(mask_size)
+        tissue = np.array(thumbnail)[:rows * mask_pixels_per_tile, :cols * mask_pixels_per_tile] < background_threshold
+        tissue_fraction = tissue.reshape(rows, mask_pixels_per_tile, cols, mask_pixels_per_tile).mean(axis=(1, 3))
+        return tissue_fraction >= min_tissue_fraction
+
+    @staticmethod
+    def _is_aligned_with_frame_grid(wsi: WsiDicom, tile_size: int, level: int) -> bool:
+        """
+        Checks whether the tile grid lines up with the frame grid stored at a certain level, 
+        i.e. whether the stored frames are square and of the requested tile size.
+
+        Parameters
+        ---------- 
+        wsi: 'WsiDicom'
+            WsiDicom object to be considered for now.
+        tile_size: int
+            Size of the tiles. 
+        level: int 
+            Level at which the tiles should be extracted 
+
+        Returns
+        -------
+        bool
+            True if every tile corresponds to exactly one stored frame.   
+        """ 
+        # Older wsidicom versions provide levels.get_level, newer ones levels.get
+        get_level = getattr(wsi.levels, 'get_level', None) or getattr(wsi.levels, 'get', None)
+        if get_level is None: # level lookup not supported by this wsidicom version, fall back to read_region
+            return False
+        try:
+            frame_size = get_level(level).default_instance.tile_size
+        except (AttributeError, KeyError): # level or instance attributes not available in this wsidicom version
+            return False
+        return frame_size.width == frame_size.height == tile_size
     
     def __iter__(self):
+        self.close()
         self._tile_index = 0
+        if self._num_workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=self._num_workers)
+        return self
+
+    def close(self) -> None:
+        """
+        Discards all tiles that are read ahead and shuts down the background threads, if any.
+        """
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __enter__(self) -> 'BatchIterator':
         return self
 
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
     @staticmethod
-    def _scale_tile(tile: Image.Image) -> np.ndarray:
+    def _scale_tile(tile: np.ndarray, out: np.ndarray) -> np.ndarray:
         """
-        Scales image values to [-1, 1], the expected input for InceptionV3 network
+        Scales image values to [-1, 1], the expected input for InceptionV3 network, 
+        writing the result in place into out. Integer outputs receive the unscaled values.
 
         Parameters
         ---------- 
-        tile: Image.Image
+        tile: np.ndarray
             Tile to be rescaled.
+        out: np.ndarray
+            Array to write the rescaled tile to.
+
+        Returns
+        -------
+        np.ndarray
+            Tile with rescaled values, i.e. out. 
+        """ 
+        if not np.issubdtype(out.dtype, np.floating):
+            out[...] = tile
+            return out
+        np.divide(tile, 127.5, out=out, dtype=out.dtype, casting='unsafe')
+        return np.subtract(out, 1.0, out=out)
+
+    def _read_tile(self, tile_pos: Tuple[int, int]) -> Image.Image:
+        """
+        Reads a tile, either as a whole stored frame if the tile grid lines up with the frame grid
+        or as an arbitrary region otherwise.
+
+        Parameters
+        ---------- 
+        tile_pos: tuple
+            Position of the tile as (col, row).
+
+        Returns
+        -------
+        Image.Image
+            Tile as read from the WSI. 
+        """ 
+        if self._read_native_tiles:
+            return self._wsi.read_tile(self._level, tile=tile_pos)
+        pixel_pos = tile_pos[0] * self._tile_size, tile_pos[1] * self._tile_size
+        return self._wsi.read_region(level=self._level, location=pixel_pos, size=(self._tile_size, self._tile_size)) 
+
+    def _load_tile(self, tile_pos: Tuple[int, int]) -> Optional[np.ndarray]:
+        """
+        Reads a tile and checks it with the accept function. 
+        May be called from a background thread.
+
+        Parameters
+        ---------- 
+        tile_pos: tuple
+            Position of the tile as (col, row).
 
         Returns
         -------
         np.ndarray
-            Tile with rescaled values. 
+            Tile as uint8 array or None if the tile is discarded by the accept function. 
+        """ 
+        tile = self._read_tile(tile_pos)
+        assert tile.size[0] == tile.size[1] == self._tile_size
+
+        if self._accept_function(tile):
+            return np.asarray(tile)
+        return None
+
+    def _has_next_tile(self) -> bool:
+        return self._tile_index < len(self._tile_positions) or len(self._pending) > 0
+
+    def _next_tile(self) -> Tuple[Tuple[int, int], Optional[np.ndarray]]:
+        """
+        Gets the next tile in tile position order. If background threads are used, the read-ahead
+        window is topped up to prefetch_batches * batch_size tiles before waiting for the next tile.
+
+        Returns
+        -------
+        tuple
+            Tuple with the first element being the tile position and the second element being 
+            the tile or None if the tile is discarded. 
         """ 
-        return (img_to_array(tile) / 127.5) - 1.0
+        if self._executor is None:
+            tile_pos = self._tile_positions[self._tile_index]
+            self._tile_index += 1
+            return (tile_pos, self._load_tile(tile_pos))
+
+        max_pending = self._prefetch_batches * self._batch_size
+        while self._tile_index < len(self._tile_positions) and len(self._pending) < max_pending:
+            tile_pos = self._tile_positions[self._tile_index]
+            self._pending.append((tile_pos, self._executor.submit(self._load_tile, tile_pos)))
+            self._tile_index += 1
+        tile_pos, future = self._pending.popleft()
+        return (tile_pos, future.result())
 
     def __next__(self) -> Tuple[np.ndarray, List[Tuple[int, int]]]:
         """
@@ -111,28 +325,24 @@ class BatchIterator:
         tuple
             Tuple with the first element being all tiles in the batch as np.ndarray and 
             the second element being a list of tile positions corresponding to the tiles.
+            The array is a view into a reused buffer, see num_buffers.
         """ 
-        batch_images = np.empty((self._batch_size, self._tile_size, self._tile_size, 3))
+        batch_images = self._batch_buffers[self._buffer_index]
         batch_tile_positions = [None] * self._batch_size
 
         curr_batch_size = 0
-        while self._tile_index < len(self._tile_positions) and curr_batch_size < self._batch_size: 
-            tile_pos = self._tile_positions[self._tile_index]
-            pixel_pos = tile_pos[0] * self._tile_size, tile_pos[1] * self._tile_size
-            tile = self._wsi.read_region(level=self._level, location=pixel_pos, size=(self._tile_size, self._tile_size)) 
-            assert tile.size[0] == tile.size[1] == self._tile_size
+        while self._has_next_tile() and curr_batch_size < self._batch_size: 
+            tile_pos, tile = self._next_tile()
 
-            if self._accept_function(tile):
-                tile = self._scale_tile(tile)
-                batch_images[curr_batch_size] = tile[np.newaxis, ...]  # add batch dimension
+            if tile is not None:
+                self._scale_tile(tile, out=batch_images[curr_batch_size])
                 batch_tile_positions[curr_batch_size] = tile_pos
                 curr_batch_size += 1
-            
-            self._tile_index += 1
 
         if curr_batch_size > 0:
-            batch_images.resize((curr_batch_size, self._tile_size, self._tile_size, 3))
+            self._buffer_index = (self._buffer_index + 1) % len(self._batch_buffers)
             batch_tile_positions = batch_tile_positions[0:curr_batch_size]
-            return (batch_images, batch_tile_positions)
+            return (batch_images[0:curr_batch_size], batch_tile_positions)
         else:
+            self.close()
             raise StopIteration
\ No newline at end of file
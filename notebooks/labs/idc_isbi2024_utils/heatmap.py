@@ -1,10 +1,13 @@
+import os
 import numpy as np
 import pandas as pd
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.colors import Colormap
+from concurrent.futures import ProcessPoolExecutor
 from copy import copy
-from typing import List
+from PIL import Image
+from typing import List, Optional, Tuple
 from .predictions import Predictions
 from .global_variables import CLASS_LABEL_TO_INDEX_MAP, NUM_CLASSES
 
@@ -26,23 +29,98 @@ def generate_heatmap(predictions: Predictions, image_id: str, colormap_strings:
     np.array
         Heatmap. 
     """ 
-    image_predictions = predictions.get_results_of_image(image_id)
-    pred = np.stack(image_predictions['predicted_class_probabilities'])
-    coord = np.stack(image_predictions['tile_position'])
-    max_cols = max([c[0] for c in coord]) + 1
-    max_rows = max([c[1] for c in coord]) + 1
-    colormaps = _get_colormaps(colormap_strings)
+    pred = predictions.get_probabilities_of_image(image_id)
+    coord = predictions.get_tile_positions_of_image(image_id)
+    return _render_heatmap(pred, coord, _get_colormaps(colormap_strings))
 
+
+def _render_heatmap(pred: np.ndarray, coord: np.ndarray, colormaps: List[Colormap]) -> np.ndarray:
+    """
+    Renders a heatmap from the predictions of the tiles of one slide.      
+    
+    Parameters
+    ---------- 
+    pred: np.ndarray
+        Predicted class probabilities of shape (num_tiles, num_classes).
+    coord: np.ndarray
+        Tile positions (col, row) of shape (num_tiles, 2).
+    colormaps: list
+        List of colormap objects, one per class.
+    
+    Returns
+    -------
+    np.array
+        Heatmap. 
+    """ 
+    max_cols = coord[:, 0].max() + 1
+    max_rows = coord[:, 1].max() + 1
+
+    predicted_classes = pred.argmax(axis=1)
+    max_p = pred.max(axis=1)
     slide_heatmap = np.zeros((max_rows, max_cols, 4)) # initialize heatmap with 0
-    for c, p in zip(coord, pred):
-        p = p.tolist()
-        max_p = max(p)
-        colormap_to_use = colormaps[p.index(max_p)] 
-        slide_heatmap[c[1], c[0], :] = colormap_to_use(max_p)
+    for class_index, colormap in enumerate(colormaps):
+        mask = predicted_classes == class_index
+        slide_heatmap[coord[mask, 1], coord[mask, 0], :] = colormap(max_p[mask])
 
     return slide_heatmap
 
 
+def export_heatmaps(predictions: Predictions, output_dir: str, colormap_strings: List[str] = ['Greys', 'Oranges', 'Blues'],
+                    num_workers: Optional[int] = None) -> pd.DataFrame:
+    """
+    Renders the heatmaps of all slides in a process pool and writes them as compressed PNG files 
+    (one pixel per tile) to output_dir, together with an index file heatmaps.csv recording the 
+    file name and grid dimensions of every slide's heatmap.      
+    
+    Parameters
+    ---------- 
+    predictions: Predictions
+        Predictions object to work with.
+    output_dir: str
+        Folder where to store the heatmaps and the index file.
+    colormap_strings: list
+        List of color strings.
+    num_workers: int
+        Number of worker processes. Default: None, i.e. the number of CPUs.
+    
+    Returns
+    -------
+    pd.DataFrame
+        Index with columns image_id, file_name, cols and rows. 
+    """ 
+    os.makedirs(output_dir, exist_ok=True)
+    image_ids = predictions.get_all_image_ids()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(_export_heatmap, 
+                                   predictions.get_probabilities_of_image(image_id), 
+                                   predictions.get_tile_positions_of_image(image_id), 
+                                   colormap_strings, 
+                                   os.path.join(output_dir, image_id + '.png'))
+                   for image_id in image_ids]
+        grid_sizes = [future.result() for future in futures]
+
+    index = pd.DataFrame({'image_id': image_ids, 
+                          'file_name': [image_id + '.png' for image_id in image_ids], 
+                          'cols': [cols for (cols, _) in grid_sizes], 
+                          'rows': [rows for (_, rows) in grid_sizes]})
+    index.to_csv(os.path.join(output_dir, 'heatmaps.csv'), index=False)
+    return index
+
+
+def _export_heatmap(pred: np.ndarray, coord: np.ndarray, colormap_strings: List[str], path: str) -> Tuple[int, int]:
+    """
+    Renders the heatmap of one slide and writes it as RGBA PNG file. Runs in a worker process.      
+    
+    Returns
+    -------
+    tuple
+        Grid dimensions (cols, rows) of the heatmap. 
+    """ 
+    slide_heatmap = _render_heatmap(pred, coord, _get_colormaps(colormap_strings))
+    Image.fromarray(np.round(slide_heatmap * 255).astype(np.uint8)).save(path, optimize=True)
+    return (slide_heatmap.shape[1], slide_heatmap.shape[0])
+
+
 def _get_colormaps(colormap_strings: List[str]) -> List[Colormap]:
     """
     Obtains a bright-to-dark Colormap object for each color in 
@@ -1,9 +1,10 @@
 import os
 import json
+import time
 import numpy as np 
 import tensorflow as tf
 from tensorflow.keras.callbacks import ModelCheckpoint, CSVLogger
-from tensorflow.keras.models import load_model
+from tensorflow.keras.models import clone_model, load_model
 from tensorflow.keras.layers import GlobalAveragePooling2D, Dense
 from tensorflow.keras import Model
 from typing import Dict, Generator, Tuple
@@ -17,6 +18,8 @@ class BaseModel:
     ----------
     model: tf.keras.Model
         Neural network model. 
+    _inference_function: tf.types.experimental.GenericFunction
+        Compiled inference function on uint8 batches as created by compile_for_inference, None if not compiled.
     """
 
     def __init__(self, model=None, *args, **kwargs):
@@ -32,6 +35,7 @@ class BaseModel:
             self.model = model 
         else: 
             self.model = self._create_model(*args, **kwargs)
+        self._inference_function = None
     
     @classmethod
     def load(cls, file_path: str) -> tf.keras.Model:
@@ -160,9 +164,75 @@ class BaseModel:
             Array of class predictions. 
         """ 
         # Make prediction 
+        if batch.dtype == np.uint8:
+            if self._inference_function is not None:
+                return self._inference_function(batch)
+            # Scale to [-1, 1], as the model expects, see BatchIterator
+            batch = batch.astype(np.float32) / 127.5 - 1.0
         prediction = self.model(batch)
         return prediction
 
+    def compile_for_inference(self, tile_size: int, policy: str = 'mixed_bfloat16', jit_compile: bool = True) -> None:
+        """
+        Compiles an inference function taking uint8 batches of shape (None, tile_size, tile_size, 3).
+        The scaling to [-1, 1] is part of the compiled graph and the forward pass is run on a copy
+        of the model built under the given mixed precision policy. Afterwards, make_prediction uses
+        the compiled function for uint8 batches, e.g. as returned by BatchIterator(..., dtype=np.uint8).
+
+        Parameters
+        ----------
+        tile_size: int
+            Size of the tiles.
+        policy: str
+            Keras mixed precision policy, e.g. 'mixed_bfloat16' or 'float32'. Default: 'mixed_bfloat16'.
+        jit_compile: bool
+            Whether to compile the function with XLA. Default: True.
+        """
+        # Layer configs record the dtype policy the layers were built with, hence it is removed 
+        # when cloning, such that the layers of the copy pick up the global policy
+        previous_policy = tf.keras.mixed_precision.global_policy()
+        tf.keras.mixed_precision.set_global_policy(policy)
+        try:
+            inference_model = clone_model(self.model, clone_function=_clone_layer_without_dtype)
+        finally:
+            tf.keras.mixed_precision.set_global_policy(previous_policy)
+        inference_model.set_weights(self.model.get_weights())
+        compute_dtype = tf.keras.mixed_precision.Policy(policy).compute_dtype
+        for layer in inference_model.layers:
+            if not isinstance(layer, tf.keras.layers.InputLayer) and layer.compute_dtype != compute_dtype:
+                raise ValueError('Layer %s computes in %s instead of %s.' % (layer.name, layer.compute_dtype, compute_dtype))
+
+        @tf.function(input_signature=[tf.TensorSpec(shape=(None, tile_size, tile_size, 3), dtype=tf.uint8)],
+                     jit_compile=jit_compile)
+        def inference_function(batch):
+            scaled_batch = tf.cast(batch, compute_dtype) / 127.5 - 1.0
+            return tf.cast(inference_model(scaled_batch, training=False), tf.float32)
+
+        self._inference_function = inference_function
+
+    def measure_throughput(self, batch: np.ndarray, num_batches: int = 10) -> float:
+        """
+        Measures the inference throughput of make_prediction for a given batch. 
+        The first call is excluded, as it may include tracing and compilation.
+
+        Parameters
+        ----------
+        batch: np.ndarray
+            Batch of elements to run inference on repeatedly.
+        num_batches: int
+            Number of timed calls. Default: 10.
+
+        Returns
+        -------
+        float
+            Throughput in tiles per second. 
+        """
+        np.asarray(self.make_prediction(batch))
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            np.asarray(self.make_prediction(batch))
+        return num_batches * len(batch) / (time.perf_counter() - start)
+
     def save(self, output_dir: str) -> None:
         """
         Function storing the neural network model in SavedModel format.  
@@ -177,6 +247,40 @@ class BaseModel:
             overwrite=True,
             include_optimizer=False)
 
+    def export_tflite(self, output_dir: str, quantize: bool = False) -> str:
+        """
+        Function exporting the neural network model to a TFLite flatbuffer, which can be 
+        used for inference with TFLitePredictor without importing TensorFlow/Keras.  
+
+        Parameters
+        ----------
+        output_dir: str
+            Folder where to store the model.
+        quantize: bool
+            Whether to apply dynamic range quantization of the weights. Default: False.
+
+        Returns
+        -------
+        str
+            Path to the exported model. 
+        """
+        converter = tf.lite.TFLiteConverter.from_keras_model(self.model)
+        if quantize:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        file_path = os.path.join(output_dir, 'trained_model.tflite')
+        with open(file_path, 'wb') as model_file:
+            model_file.write(converter.convert())
+        return file_path
+
+
+def _clone_layer_without_dtype(layer: tf.keras.layers.Layer) -> tf.keras.layers.Layer:
+    """
+    Creates a new layer from the config of the given layer, except for its dtype policy.
+    """
+    config = layer.get_config()
+    config.pop('dtype', None)
+    return layer.__class__.from_config(config)
+
 
 class InceptionModel(BaseModel):
     
@@ -0,0 +1,237 @@
+import os
+import queue
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from wsidicom import WsiDicom
+from PIL import Image
+from typing import Callable, List, Optional, Set
+
+from .batch_iterator import BatchIterator
+from .predictions import Predictions
+
+
+COMPLETED_SLIDES_FILENAME = 'completed_slides.txt'
+
+
+def predict_slides(model, slide_paths: List[str], tile_size: int, level: int,
+                   accept_function: Callable[[Image.Image], bool], batch_size: int = 32,
+                   coverage: float = 1.0, image_ids: Optional[List[str]] = None,
+                   reference_class_indices: Optional[List[int]] = None, num_slide_workers: int = 2,
+                   num_tile_workers: int = 0, min_tissue_fraction: Optional[float] = None,
+                   checkpoint_dir: Optional[str] = None) -> Predictions:
+    """
+    Performs inference for a cohort of slides. Slides are opened, tiled and filtered concurrently
+    and their tiles are merged into one stream of batches of batch_size tiles, such that batches
+    are only partially filled at the very end of the cohort, not at every slide boundary.
+
+    Parameters
+    ----------
+    model: BaseModel or TFLitePredictor
+        Model whose make_prediction function is called for every batch.
+    slide_paths: list
+        Paths to the slides as accepted by WsiDicom.open.
+    tile_size: int
+        Size of the tiles.
+    level: int
+        Level at which the tiles should be extracted
+    accept_function: Callable
+        Function defining whether a tile is discarded or used for analysis.
+    batch_size: int
+        Batch size for network inference. Default: 32.
+    coverage: float
+        Percentage of tiles of a WSI that should be used for inference. Default: 1.0.
+    image_ids: list
+        Image ID for every slide. Default: None, i.e. the base names of slide_paths.
+    reference_class_indices: list
+        Reference class index for every slide. Default: None, i.e. the reference class index is set to -1.
+    num_slide_workers: int
+        Number of slides that are tiled concurrently. Default: 2.
+    num_tile_workers: int
+        Number of threads reading tiles per slide, see BatchIterator. Default: 0.
+    min_tissue_fraction: float
+        Minimum tissue fraction on the thumbnail for a tile position to be read, see BatchIterator. Default: None.
+    checkpoint_dir: str
+        If given, the predictions of every slide are written to <image_id>.parquet in this folder as soon as
+        the slide is completed and the slide is recorded in completed_slides.txt. Slides recorded there are
+        skipped when the function is called again, e.g. after a crash, and only the predictions of slides in
+        progress are kept in memory. The returned predictions are loaded from the files of the given slides 
+        only. Default: None, i.e. all predictions are kept in memory.
+
+    Returns
+    -------
+    Predictions
+        Per-tile predictions of all slides.
+    """
+    if image_ids is None:
+        image_ids = [os.path.basename(os.path.normpath(path)) for path in slide_paths]
+    if reference_class_indices is None:
+        reference_class_indices = [-1] * len(slide_paths)
+    assert len(image_ids) == len(slide_paths) == len(reference_class_indices)
+
+    completed_image_ids = set()
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        completed_image_ids = _read_completed_image_ids(checkpoint_dir)
+    slide_indices_to_process = [i for i in range(len(slide_paths)) if image_ids[i] not in completed_image_ids]
+
+    tiles_queue = queue.Queue(maxsize=2 * max(1, num_slide_workers))
+    stop_event = threading.Event()
+
+    def _tile_slide(slide_index: int) -> None:
+        if stop_event.is_set(): # do not open further slides once the consumer has stopped
+            return
+        try:
+            wsi = WsiDicom.open(slide_paths[slide_index])
+            # The BatchIterator is closed on leaving the block, such that its tile threads are shut down on errors as well
+            with BatchIterator(wsi, tile_size, level, accept_function, batch_size=batch_size,
+                               coverage=coverage, num_workers=num_tile_workers,
+                               min_tissue_fraction=min_tissue_fraction) as batch_iterator:
+                for (batch_images, batch_tile_positions) in batch_iterator:
+                    # Batches are views into buffers reused by the BatchIterator, hence they are copied
+                    if not _put(tiles_queue, (slide_index, batch_images.copy(), batch_tile_positions), stop_event):
+                        return
+        except Exception as e:
+            _put(tiles_queue, e, stop_event)
+            return
+        _put(tiles_queue, (slide_index, None, None), stop_event)  # marks the end of the slide
+
+    batch_images = np.empty((batch_size, tile_size, tile_size, 3), dtype=np.float32)
+    batch_slide_indices = np.empty(batch_size, dtype=np.int64)
+    batch_tile_positions = []
+    slide_results = {slide_index: ([], []) for slide_index in slide_indices_to_process}
+    ended_slides = set()
+    finished_results = []
+
+    def _finish_slides(slide_indices: Set[int]) -> None:
+        for slide_index in slide_indices:
+            tile_positions, probabilities = slide_results.pop(slide_index)
+            predictions = _to_predictions(slide_index, tile_positions, probabilities,
+                                          image_ids, reference_class_indices)
+            if checkpoint_dir is None:
+                finished_results.append(predictions)
+            else:
+                _write_slide_predictions(checkpoint_dir, image_ids[slide_index], predictions)
+        ended_slides.difference_update(slide_indices)
+
+    def _predict_batch(curr_batch_size: int) -> None:
+        batch_probabilities = np.asarray(model.make_prediction(batch_images[0:curr_batch_size]))
+        for i in range(curr_batch_size):
+            tile_positions, probabilities = slide_results[batch_slide_indices[i]]
+            tile_positions.append(batch_tile_positions[i])
+            probabilities.append(batch_probabilities[i])
+        batch_tile_positions.clear()
+        _finish_slides(set(ended_slides))
+
+    with ThreadPoolExecutor(max_workers=max(1, num_slide_workers)) as executor:
+        futures = []
+        try:
+            for slide_index in slide_indices_to_process:
+                futures.append(executor.submit(_tile_slide, slide_index))
+
+            curr_batch_size = 0
+            num_ended_slides = 0
+            while num_ended_slides < len(slide_indices_to_process):
+                item = tiles_queue.get()
+                if isinstance(item, Exception):
+                    raise item
+
+                slide_index, slide_images, slide_tile_positions = item
+                if slide_images is None:
+                    num_ended_slides += 1
+                    ended_slides.add(slide_index)
+                    if slide_index not in batch_slide_indices[0:curr_batch_size]:
+                        _finish_slides({slide_index})
+                    continue
+
+                start = 0
+                while start < len(slide_images):
+                    n = min(batch_size - curr_batch_size, len(slide_images) - start)
+                    batch_images[curr_batch_size:curr_batch_size + n] = slide_images[start:start + n]
+                    batch_slide_indices[curr_batch_size:curr_batch_size + n] = slide_index
+                    batch_tile_positions.extend(slide_tile_positions[start:start + n])
+                    curr_batch_size += n
+                    start += n
+                    if curr_batch_size == batch_size:
+                        _predict_batch(curr_batch_size)
+                        curr_batch_size = 0
+
+            if curr_batch_size > 0:
+                _predict_batch(curr_batch_size)
+        finally:
+            stop_event.set()
+            for future in futures:
+                future.cancel()
+
+    if checkpoint_dir is not None:
+        return Predictions.load_parquet([_get_checkpoint_path(checkpoint_dir, image_id) for image_id in image_ids])
+    if len(finished_results) == 0:
+        return Predictions(pd.DataFrame(columns=['image_id', 'tile_position', 'reference_class_index', 
+                                                 'predicted_class_index', 'predicted_class_probabilities']))
+    return Predictions(pd.concat([p._predictions for p in finished_results], ignore_index=True))
+
+
+def _put(tiles_queue: queue.Queue, item: object, stop_event: threading.Event) -> bool:
+    """
+    Puts an item into a bounded queue, giving up once the consumer has stopped.
+
+    Returns
+    -------
+    bool
+        True if the item was put into the queue, False if the consumer has stopped.
+    """
+    while not stop_event.is_set():
+        try:
+            tiles_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _to_predictions(slide_index: int, tile_positions: List, probabilities: List[np.ndarray],
+                    image_ids: List[str], reference_class_indices: List[int]) -> Predictions:
+    """
+    Builds a Predictions object from the per-tile results of one slide.
+    """
+    num_tiles = len(tile_positions)
+    dictionary = {'image_id': [image_ids[slide_index]] * num_tiles,
+                  'tile_position': tile_positions,
+                  'reference_class_index': [reference_class_indices[slide_index]] * num_tiles,
+                  'predicted_class_index': [int(np.argmax(p)) for p in probabilities],
+                  'predicted_class_probabilities': probabilities}
+    return Predictions(pd.DataFrame(dictionary))
+
+
+def _read_completed_image_ids(checkpoint_dir: str) -> Set[str]:
+    """
+    Reads the image IDs of all slides recorded as completed in a checkpoint folder.
+    """
+    path = os.path.join(checkpoint_dir, COMPLETED_SLIDES_FILENAME)
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as completed_slides:
+        return set(line.strip() for line in completed_slides if line.strip())
+
+
+def _get_checkpoint_path(checkpoint_dir: str, image_id: str) -> str:
+    """
+    Returns the path of the parquet file holding the predictions of one slide.
+    """
+    return os.path.join(checkpoint_dir, image_id + '.parquet')
+
+
+def _write_slide_predictions(checkpoint_dir: str, image_id: str, predictions: Predictions) -> None:
+    """
+    Writes the predictions of one slide to the checkpoint folder and records the slide as completed.
+    The parquet file is written under a temporary name first, such that an interrupted write
+    never leaves a partial file behind.
+    """
+    path = _get_checkpoint_path(checkpoint_dir, image_id)
+    predictions.save_parquet(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    with open(os.path.join(checkpoint_dir, COMPLETED_SLIDES_FILENAME), 'a') as completed_slides:
+        completed_slides.write(image_id + '\n')
+        completed_slides.flush()
+        os.fsync(completed_slides.fileno())
@@ -1,5 +1,8 @@
+import os
+import numpy as np
 import pandas as pd
-from typing import List
+from glob import glob
+from typing import List, Tuple, Union
 
 
 class Predictions():
@@ -10,7 +13,13 @@ class Predictions():
     ----------
     _predictions: pd.DataFrame
         Dataframe with columns image_id, tile_position, reference_class_index, 
-        predicted_class_index and predicted_class_probabilites.
+        predicted_class_index and predicted_class_probabilites, sorted by image_id.
+    _image_offsets: dict
+        Mapping of every image ID to the (start, stop) rows of its predictions. Built on first access.
+    _probabilities: np.ndarray
+        Array of shape (num_tiles, num_classes) with the predicted class probabilities of all tiles.
+    _tile_positions: np.ndarray
+        Array of shape (num_tiles, 2) with the (col, row) tile positions of all tiles.
     """ 
     
     def __init__(self, predictions: pd.DataFrame) -> None:
@@ -22,7 +31,31 @@ class Predictions():
         predictions: pd.DataFrame
             Dataframe summarizing all predictions made by the network.
         """ 
-        self._predictions = predictions
+        self._predictions = predictions.sort_values('image_id', kind='stable', ignore_index=True)
+        self._image_offsets = None
+        self._probabilities = None
+        self._tile_positions = None
+
+    def _build_index(self) -> None:
+        """
+        Builds the per-image index and the contiguous arrays of probabilities and tile positions.
+        """ 
+        image_ids = self._predictions['image_id'].to_numpy()
+        self._image_offsets = dict()
+        self._probabilities = np.empty((0, 0))
+        self._tile_positions = np.empty((0, 2), dtype=np.int64)
+        if len(image_ids) == 0:
+            return
+        boundaries = (np.flatnonzero(image_ids[1:] != image_ids[:-1]) + 1).tolist()
+        for start, stop in zip([0] + boundaries, boundaries + [len(image_ids)]):
+            self._image_offsets[image_ids[start]] = (start, stop)
+        self._probabilities = np.stack(self._predictions['predicted_class_probabilities'].to_numpy())
+        self._tile_positions = np.asarray(self._predictions['tile_position'].tolist()).reshape(-1, 2)
+
+    def _get_offsets(self, image_id: str) -> Tuple[int, int]:
+        if self._image_offsets is None:
+            self._build_index()
+        return self._image_offsets.get(image_id, (0, 0))
 
     def save(self, path: str) -> None:
         """
@@ -34,7 +67,59 @@ class Predictions():
             Complete path to save the predictions' csv table.
         """
         self._predictions.to_csv(path, index=False)
-    
+
+    def save_parquet(self, path: str) -> None:
+        """
+        Saves the predictions to a parquet file. Tile positions are stored as int32 columns 
+        tile_col and tile_row and class probabilities as lists of float32 values. The schema 
+        is explicit, such that the column types are kept for slides without any tiles.
+
+        Parameters
+        -------
+        path: str
+            Complete path to save the predictions' parquet file.
+        """
+        import pyarrow as pa
+        predictions = self._predictions.drop(columns=['tile_position'])
+        tile_positions = np.asarray(self._predictions['tile_position'].tolist(), dtype=np.int32).reshape(-1, 2)
+        predictions.insert(1, 'tile_col', tile_positions[:, 0])
+        predictions.insert(2, 'tile_row', tile_positions[:, 1])
+        predictions['predicted_class_probabilities'] = pd.Series([np.asarray(p, dtype=np.float32) 
+                                                                  for p in predictions['predicted_class_probabilities']], 
+                                                                 index=predictions.index, dtype=object)
+        schema = pa.schema([('image_id', pa.string()), ('tile_col', pa.int32()), ('tile_row', pa.int32()), 
+                            ('reference_class_index', pa.int64()), ('predicted_class_index', pa.int64()), 
+                            ('predicted_class_probabilities', pa.list_(pa.float32()))])
+        predictions.to_parquet(path, index=False, schema=schema)
+
+    @classmethod
+    def load_parquet(cls, path: Union[str, List[str]]) -> 'Predictions':
+        """
+        Loads predictions stored with save_parquet. 
+
+        Parameters
+        -------
+        path: str or list
+            Path to a parquet file, to a folder, in which case all parquet files in it are loaded, 
+            or list of paths to parquet files.
+
+        Returns
+        -------
+        Predictions
+            Predictions object. 
+        """
+        if isinstance(path, list):
+            paths = path
+        else:
+            paths = sorted(glob(os.path.join(path, '*.parquet'))) if os.path.isdir(path) else [path]
+        if len(paths) == 0:
+            return cls(pd.DataFrame(columns=['image_id', 'tile_position', 'reference_class_index', 
+                                             'predicted_class_index', 'predicted_class_probabilities']))
+        predictions = pd.concat([pd.read_parquet(p) for p in paths], ignore_index=True)
+        tile_positions = list(zip(predictions.pop('tile_col').tolist(), predictions.pop('tile_row').tolist()))
+        predictions.insert(1, 'tile_position', pd.Series(tile_positions, index=predictions.index, dtype=object))
+        return cls(predictions)
+
     def get_all_image_ids(self) -> List:
         """
         Gets all image IDs for which tile predictions have been made. 
@@ -44,7 +129,9 @@ class Predictions():
         list
             List of image IDs. 
         """ 
-        return sorted(list(set(self._predictions['image_id'].tolist())))
+        if self._image_offsets is None:
+            self._build_index()
+        return list(self._image_offsets.keys())
 
     def get_results_of_image(self, image_id: str) -> pd.DataFrame:
         """
@@ -60,4 +147,39 @@ class Predictions():
         pd.DataFrame
             Subsample of self._predictions containing only predictions for image_id. 
         """ 
-        return self._predictions.loc[self._predictions['image_id'] == image_id]
\ No newline at end of file
+        start, stop = self._get_offsets(image_id)
+        return self._predictions.iloc[start:stop]
+
+    def get_probabilities_of_image(self, image_id: str) -> np.ndarray:
+        """
+        Gets the predicted class probabilities of all tiles of a certain image ID.  
+
+        Parameters
+        ----------
+        image_id: str
+            Image ID of interest.
+
+        Returns
+        -------
+        np.ndarray
+            View of shape (num_tiles, num_classes) into the probabilities of all predictions. 
+        """ 
+        start, stop = self._get_offsets(image_id)
+        return self._probabilities[start:stop]
+
+    def get_tile_positions_of_image(self, image_id: str) -> np.ndarray:
+        """
+        Gets the tile positions of all tiles of a certain image ID.  
+
+        Parameters
+        ----------
+        image_id: str
+            Image ID of interest.
+
+        Returns
+        -------
+        np.ndarray
+            View of shape (num_tiles, 2) with (col, row) into the tile positions of all predictions. 
+        """ 
+        start, stop = self._get_offsets(image_id)
+        return self._tile_positions[start:stop]
\ No newline at end of file
@@ -0,0 +1,67 @@
+import numpy as np
+try:
+    from ai_edge_litert.interpreter import Interpreter
+except ImportError:
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf # tf.lite is loaded lazily, so its members cannot be imported directly
+        Interpreter = tf.lite.Interpreter
+
+
+class TFLitePredictor:
+    """
+    Lightweight predictor for models exported with BaseModel.export_tflite. Only requires the
+    ai-edge-litert or tflite-runtime package, falling back to TensorFlow if neither is installed.
+
+    Attributes
+    ----------
+    _interpreter: Interpreter
+        TFLite interpreter holding the model.
+    _input_index: int
+        Index of the input tensor.
+    _output_index: int
+        Index of the output tensor.
+    """
+
+    def __init__(self, file_path: str, num_threads: int = 1) -> None:
+        """
+        Constructor of TFLitePredictor.
+
+        Parameters
+        ----------
+        file_path: str
+            Path to the exported model in TFLite format.
+        num_threads: int
+            Number of threads used by the interpreter. Default: 1.
+        """
+        self._interpreter = Interpreter(model_path=file_path, num_threads=num_threads)
+        self._interpreter.allocate_tensors()
+        self._input_index = self._interpreter.get_input_details()[0]['index']
+        self._output_index = self._interpreter.get_output_details()[0]['index']
+
+    def make_prediction(self, batch: np.ndarray) -> np.ndarray:
+        """
+        Function to make a prediction for one batch.
+
+        Parameters
+        ----------
+        batch: np.ndarray
+            Batch of elements to obtain a prediction for, either scaled to [-1, 1] or as uint8,
+            e.g. as returned by BatchIterator(..., dtype=np.uint8).
+
+        Returns
+        -------
+        np.ndarray
+            Array of class predictions.
+        """
+        if batch.dtype == np.uint8:
+            # Scale to [-1, 1], as the model expects, see BatchIterator
+            batch = batch.astype(np.float32) / 127.5 - 1.0
+        input_shape = self._interpreter.get_input_details()[0]['shape']
+        if tuple(input_shape) != batch.shape:
+            self._interpreter.resize_tensor_input(self._input_index, batch.shape)
+            self._interpreter.allocate_tensors()
+        self._interpreter.set_tensor(self._input_index, np.ascontiguousarray(batch, dtype=np.float32))
+        self._interpreter.invoke()
+        return self._interpreter.get_tensor(self._output_index).copy()
@@ -1,5 +1,7 @@
 import os
+import numpy as np
 import pandas as pd
+from PIL import Image
 from typing import Any, Dict
 
 def _get_reference_class_label(slide_metadata: pd.DataFrame) -> str:
@@ -61,3 +63,52 @@ def create_slides_metadata(bq_results_df: pd.DataFrame, local_slides_dir: str) -
 
     return pd.DataFrame.from_records(list(slides_metadata.values()),
                                      index=list(slides_metadata.keys()))
+
+
+def get_background_fractions(tiles: np.ndarray, threshold: int = 220, downsample: int = 1) -> np.ndarray:
+    """
+    Computes the fraction of background pixels, i.e. pixels with a grey value >= threshold, 
+    for a stack of tiles in one vectorized pass. Grey values are computed like PIL's conversion 
+    to mode 'L', such that results are identical to thresholding tile.convert(mode='L').
+
+    Parameters
+    ----------
+    tiles: np.ndarray
+        uint8 RGB(A) tiles of shape (N, H, W, C) or a single tile of shape (H, W, C).
+    threshold: int
+        Grey value from which on a pixel is considered as background. Default: 220.
+    downsample: int
+        Only every downsample-th pixel along both axes is considered. Default: 1.
+
+    Returns
+    -------
+    np.ndarray
+        Background fraction per tile of shape (N,), or a 0-d array for a single tile.
+    """
+    tiles = np.asarray(tiles)[..., ::downsample, ::downsample, :3].astype(np.uint32)
+    grey = (tiles[..., 0] * 19595 + tiles[..., 1] * 38470 + tiles[..., 2] * 7471 + 0x8000) >> 16 # ITU-R 601-2 luma as in PIL
+    return (grey >= threshold).mean(axis=(-2, -1))
+
+
+def is_foreground(tile: Image.Image, max_background_fraction: float = 0.5, downsample: int = 1) -> bool:
+    """
+    Accept function for BatchIterator determining if a tile shows mainly tissue (foreground) or background.
+    Tiles of other modes than RGB, e.g. greyscale ('L') or RGBA, are converted to RGB first.
+
+    Parameters
+    ----------
+    tile: Image.Image
+        Tile to be checked.
+    max_background_fraction: float
+        Maximum fraction of background pixels of a foreground tile. Default: 0.5.
+    downsample: int
+        Only every downsample-th pixel along both axes is considered. Default: 1.
+
+    Returns
+    -------
+    bool
+        True if the tile shows <= max_background_fraction background and False otherwise.
+    """
+    if tile.mode != 'RGB':
+        tile = tile.convert(mode='RGB')
+    return bool(get_background_fractions(np.asarray(tile), downsample=downsample) <= max_background_fraction)